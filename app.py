@@ -3,152 +3,1795 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pa_parquet
+import openpyxl
+import ahocorasick
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 import praw
 from praw.exceptions import PRAWException
+from praw.models import MoreComments
 from prawcore.exceptions import NotFound, Forbidden, BadRequest
+from prawcore.requestor import Requestor
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from functools import partial
+from collections import deque
+import threading
+import time
+import json
+import os
+import sqlite3
+import uuid
+import hashlib
+import contextlib
+import gzip
+import tempfile
+import math
+import random
 import re
+import abc
+import requests
 
 # --- Configuratie & Secrets ---
-CLIENT_ID = st.secrets.get("reddit_client_id")
-CLIENT_SECRET = st.secrets.get("reddit_client_secret")
-APP_PASSWORD = st.secrets.get("app_password")
-REDIRECT_URI = st.secrets.get("redirect_uri")
+def _get_secret(key: str):
+    # Zonder secrets.toml (bv. bij `python benchmark.py`) moet de module nog steeds importeerbaar zijn.
+    try: return st.secrets.get(key)
+    except FileNotFoundError: return None
+
+CLIENT_ID = _get_secret("reddit_client_id")
+CLIENT_SECRET = _get_secret("reddit_client_secret")
+APP_PASSWORD = _get_secret("app_password")
+REDIRECT_URI = _get_secret("redirect_uri")
+
+# --- Scan Presets: (posts per subreddit, comments per post) ---
+SCAN_PRESETS = {"🟢 Fast": (10, 20), "🔵 Standard": (50, 100), "🔴 Deep": (100, 500)}
 
 # --- Constanten voor Relevance Score ---
 FOUND_VIA_DIRECT = 'Direct Search'
 FOUND_VIA_POST = 'Relevant Post'
 FOUND_VIA_COMMENT = 'Relevant Comment'
 
-def calculate_relevance_score(found_via_set: set):
-    score = 0
-    if FOUND_VIA_DIRECT in found_via_set: score += 1
-    if FOUND_VIA_POST in found_via_set: score += 2
-    if FOUND_VIA_COMMENT in found_via_set: score += 3
-    return score
+# Elke bron is een bit in een integer-masker, zodat score en label per community
+# met één table lookup over de hele kolom berekend worden.
+FOUND_VIA_BITS = {FOUND_VIA_DIRECT: 1, FOUND_VIA_POST: 2, FOUND_VIA_COMMENT: 4}
+FOUND_VIA_WEIGHTS = {FOUND_VIA_DIRECT: 1, FOUND_VIA_POST: 2, FOUND_VIA_COMMENT: 3}
+RELEVANCE_BY_MASK = np.array([sum(w for via, w in FOUND_VIA_WEIGHTS.items() if mask & FOUND_VIA_BITS[via]) for mask in range(8)])
+FOUND_VIA_LABELS = np.array([', '.join(sorted(via for via, bit in FOUND_VIA_BITS.items() if mask & bit)) for mask in range(8)], dtype=object)
+
+# --- Keyword Matching (één keer gecompileerd per scan) ---
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_text(text: str) -> str:
+    """Vervangt alle witruimte door één spatie en stript de tekst."""
+    return WHITESPACE_RE.sub(' ', text or '').strip()
+
+class KeywordMatcher:
+    """
+    Matcht alle keywords in één enkele pass over de tekst.
+
+    De keywords worden gecompileerd tot een Aho-Corasick automaton, die ook
+    overlappende en in elkaar vallende matches vindt. De kosten per tekst hangen
+    daardoor nauwelijks af van het aantal keywords.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = []
+        variants = {}
+        for keyword in keywords:
+            variant = normalize_text(keyword).lower()
+            if not variant: continue
+            if variant not in variants:
+                variants[variant] = []
+            if keyword not in variants[variant]:
+                variants[variant].append(keyword)
+                self.keywords.append(keyword)
+        self._order = {keyword: i for i, keyword in enumerate(self.keywords)}
+        self._keywords_by_variant = variants
+        if variants:
+            self._automaton = ahocorasick.Automaton()
+            for variant in variants:
+                self._automaton.add_word(variant, variant)
+            self._automaton.make_automaton()
+        else:
+            self._automaton = None
+
+    def __bool__(self):
+        return bool(self.keywords)
+
+    @property
+    def variants(self) -> list:
+        """De genormaliseerde (lowercase) vormen van de keywords."""
+        return list(self._keywords_by_variant)
+
+    @property
+    def fingerprint(self) -> str:
+        """Stabiele hash van de (genormaliseerde) keywordset."""
+        return hashlib.sha1('\n'.join(sorted(self.variants)).encode('utf-8')).hexdigest()[:16]
+
+    def match(self, clean_text: str) -> list:
+        """Geeft alle gematchte keywords terug (in invoervolgorde) voor al genormaliseerde tekst."""
+        if self._automaton is None or not clean_text: return []
+        found = set()
+        for variant in {variant for _, variant in self._automaton.iter(clean_text.lower())}:
+            found.update(self._keywords_by_variant[variant])
+        return sorted(found, key=self._order.__getitem__)
+
+# --- Instrumentatie (per scan: fase-timers, requests, rate-limit) ---
+
+class ScanMetrics:
+    """
+    Thread-safe meetpunten voor één scan.
+
+    Fases worden getimed met `with metrics.phase(naam):`. De thread die in een fase zit
+    registreert zichzelf als actieve meter, zodat BudgetedRequestor de HTTP-requests van
+    die thread (aantal, bytes, retries, rate-limit headers) aan de juiste scan toeschrijft,
+    ook als Reddit-clients door meerdere scans gedeeld worden. Geneste fases tellen
+    exclusief: de tijd van een binnenste fase gaat af van de buitenste. Fase-tijden van
+    parallelle workers worden opgeteld en kunnen dus groter zijn dan de wall time.
+    """
+
+    _active = threading.local()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.cache_hits = 0
+        self.ratelimit_remaining = None
+        self.ratelimit_used = None
+        self.ratelimit_reset_at = None
+
+    @classmethod
+    def _stack(cls) -> list:
+        if not hasattr(cls._active, 'stack'): cls._active.stack = []
+        return cls._active.stack
+
+    @classmethod
+    def active(cls):
+        """De ScanMetrics van de fase waarin de huidige thread zit, of None."""
+        stack = cls._stack()
+        return stack[-1][0] if stack else None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        stack = ScanMetrics._stack()
+        frame = [self, 0.0]  # [meter, tijd in geneste fases]
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if stack and stack[-1][0] is self: stack[-1][1] += elapsed
+            with self._lock:
+                stats = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0})
+                stats['calls'] += 1
+                stats['seconds'] += elapsed - frame[1]
+
+    def record_cache_hit(self, count: int = 1):
+        with self._lock: self.cache_hits += count
+
+    def record_request(self, status_code: int = None, headers=None, nbytes: int = 0):
+        """Registreert één HTTP-poging; None als status betekent een verbindingsfout."""
+        headers = headers or {}
+        with self._lock:
+            self.requests += 1
+            self.bytes += nbytes
+            if status_code is None or status_code >= 500: self.retries += 1
+            if status_code == 429: self.rate_limited += 1
+            try:
+                if 'x-ratelimit-remaining' in headers: self.ratelimit_remaining = float(headers['x-ratelimit-remaining'])
+                if 'x-ratelimit-used' in headers: self.ratelimit_used = float(headers['x-ratelimit-used'])
+                if 'x-ratelimit-reset' in headers: self.ratelimit_reset_at = time.time() + float(headers['x-ratelimit-reset'])
+            except ValueError:
+                pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.time()
+            return {
+                'started': self.started,
+                'elapsed_s': round(now - self.started, 3),
+                'requests': self.requests,
+                'bytes': self.bytes,
+                'retries': self.retries,
+                'rate_limited': self.rate_limited,
+                'cache_hits': self.cache_hits,
+                'ratelimit_remaining': self.ratelimit_remaining,
+                'ratelimit_used': self.ratelimit_used,
+                'ratelimit_reset_s': None if self.ratelimit_reset_at is None else round(max(self.ratelimit_reset_at - now, 0), 1),
+                'phases': {name: {'calls': s['calls'], 'seconds': round(s['seconds'], 3)} for name, s in self.phases.items()},
+            }
+
+def metrics_report_rows(report: dict) -> list:
+    """Maakt een run-report ({'job': ..., 'metrics': snapshot}) plat tot metric/value-rijen voor CSV."""
+    rows = [{'metric': f"job.{key}", 'value': value} for key, value in report.get('job', {}).items() if key != 'params']
+    rows += [{'metric': f"params.{key}", 'value': ', '.join(map(str, value)) if isinstance(value, list) else value} for key, value in report.get('job', {}).get('params', {}).items()]
+    metrics = report['metrics']
+    rows += [{'metric': key, 'value': value} for key, value in metrics.items() if key != 'phases']
+    for name, stats in metrics['phases'].items():
+        rows += [{'metric': f"phase.{name}.calls", 'value': stats['calls']}, {'metric': f"phase.{name}.seconds", 'value': stats['seconds']}]
+    return rows
+
+# --- Reddit Clients & Rate Limiting ---
+
+class RateLimitBudget:
+    """
+    Thread-safe token bucket die door alle Reddit-clients van een gebruiker gedeeld wordt.
+
+    Zolang er nog geen headers binnen zijn geldt Reddit's standaard van 100 requests
+    per minuut. Daarna wordt de resterende quota (X-Ratelimit-Remaining) gelijkmatig
+    verdeeld over de tijd tot de reset (X-Ratelimit-Reset).
+    """
+
+    def __init__(self, rate: float = 100 / 60, burst: int = 10):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.remaining = None
+        self.reset_at = None
+        self._last_refill = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        """Blokkeert tot er een request-token beschikbaar is."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.remaining is not None and self.remaining <= 0 and self.reset_at and now < self.reset_at:
+                    wait_for = self.reset_at - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        if self.remaining is not None: self.remaining -= 1
+                        return
+                    wait_for = (1 - self.tokens) / self.rate
+            time.sleep(min(wait_for, 1.0))
+
+    def update(self, headers):
+        """Verwerkt de rate-limit headers van een Reddit-response."""
+        if 'x-ratelimit-remaining' not in headers: return
+        try:
+            remaining = float(headers['x-ratelimit-remaining'])
+            reset = max(float(headers.get('x-ratelimit-reset', 60)), 1.0)
+        except ValueError:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.remaining = remaining
+            self.reset_at = now + reset
+            self.rate = max(remaining, 0) / reset or 1 / reset
+            self.tokens = min(self.tokens, max(remaining, 0))
+
+    def backoff(self, seconds: float):
+        """Pauzeert alle clients na een 429-response."""
+        with self._lock:
+            self.remaining = 0
+            self.reset_at = time.monotonic() + max(seconds, 1.0)
+
+class BudgetedRequestor(Requestor):
+    """
+    prawcore Requestor die elke HTTP-request langs een gedeeld RateLimitBudget leidt
+    en hem registreert in de actieve ScanMetrics van de aanroepende thread.
+    """
+
+    def __init__(self, *args, budget: RateLimitBudget = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.budget = budget
+
+    def request(self, *args, **kwargs):
+        if self.budget: self.budget.acquire()
+        metrics = ScanMetrics.active()
+        try:
+            response = super().request(*args, **kwargs)
+        except Exception:
+            if metrics: metrics.record_request()
+            raise
+        if metrics: metrics.record_request(response.status_code, response.headers, len(response.content))
+        if self.budget:
+            self.budget.update(response.headers)
+            if response.status_code == 429:
+                self.budget.backoff(float(response.headers.get('retry-after', 60)))
+        return response
+
+def create_reddit_client(refresh_token: str, username: str, budget: RateLimitBudget = None):
+    return praw.Reddit(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, user_agent=f"TheOpportunityFinder/Boyd (user: {username})", refresh_token=refresh_token, requestor_class=BudgetedRequestor, requestor_kwargs={'budget': budget})
+
+class RedditClientPool:
+    """
+    Warme PRAW-clients per gebruiker (op refresh token), gedeeld over reruns en scans.
+
+    lease() leent een client exclusief uit aan één thread (PRAW is niet thread-safe) en
+    legt hem daarna terug, met zijn keep-alive HTTP-sessie en access token, zodat een
+    volgende scan of rerun niet opnieuw een client bouwt en een token ververst. Alle
+    clients van één gebruiker delen één RateLimitBudget. Clients die `idle_timeout`
+    seconden niet gebruikt zijn worden bij de volgende lease gesloten.
+    """
+
+    def __init__(self, factory=create_reddit_client, idle_timeout: float = 15 * 60, max_idle_per_user: int = 16):
+        self._factory = factory
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_user = max_idle_per_user
+        self._lock = threading.Lock()
+        self._users = {}  # sha256(refresh token) -> {'budget', 'idle': [(client, laatst gebruikt)], 'leased', 'last_used'}
+
+    @staticmethod
+    def _key(refresh_token: str) -> str:
+        return hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _close(client):
+        try: client._core.close()
+        except Exception: pass
+
+    def _user(self, refresh_token: str, now: float) -> dict:
+        return self._users.setdefault(self._key(refresh_token), {'budget': RateLimitBudget(), 'idle': [], 'leased': 0, 'last_used': now})
+
+    @contextlib.contextmanager
+    def lease(self, refresh_token: str, username: str):
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            user = self._user(refresh_token, now)
+            client = user['idle'].pop()[0] if user['idle'] else None
+            user['leased'] += 1
+        try:
+            if client is None: client = self._factory(refresh_token, username, user['budget'])
+            yield client
+        finally:
+            with self._lock:
+                now = time.monotonic()
+                user['leased'] -= 1
+                user['last_used'] = now
+                if client is not None and len(user['idle']) < self.max_idle_per_user: user['idle'].append((client, now))
+                elif client is not None: self._close(client)
+
+    def discard(self, refresh_token: str):
+        """Sluit alle vrije clients van een gebruiker, bv. bij uitloggen."""
+        with self._lock:
+            user = self._users.pop(self._key(refresh_token), None)
+        for client, _ in (user['idle'] if user else []): self._close(client)
+
+    def _evict_idle(self, now: float):
+        for key, user in list(self._users.items()):
+            expired = [client for client, used in user['idle'] if now - used > self.idle_timeout]
+            user['idle'] = [(client, used) for client, used in user['idle'] if now - used <= self.idle_timeout]
+            for client in expired: self._close(client)
+            if not user['idle'] and not user['leased'] and now - user['last_used'] > self.idle_timeout: del self._users[key]
+
+@st.cache_resource
+def get_reddit_client_pool():
+    return RedditClientPool()
+
+# --- Persistente Cache (SQLite, TTL + LRU) ---
+
+CACHE_PATH = '.opportunity_cache.sqlite3'
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_TTLS = {
+    'listing': 60 * 60,          # subreddit.top(...)
+    'subreddit_search': 6 * 60 * 60,
+    'post_search': 60 * 60,
+    'comments': 2 * 60 * 60,
+    'subreddit_info': 24 * 60 * 60,
+}
+
+class ScanCache:
+    """
+    On-disk cache voor Reddit-data, gedeeld door alle sessies.
+
+    Wat afhangt van de rechten van de gebruiker (listings, post-zoekresultaten, comment
+    trees: ook private en quarantined subreddits) krijgt de gebruiker in de key; alleen
+    publieke metadata (subreddit-zoekresultaten en -info) wordt tussen gebruikers gedeeld.
+
+    Elke entry heeft een soort (`kind`) met een eigen TTL. De totale grootte is
+    begrensd; bij overschrijding worden de minst recent gebruikte entries verwijderd.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, ttls: dict = None, max_bytes: int = CACHE_MAX_BYTES):
+        self.ttls = {**CACHE_TTLS, **(ttls or {})}
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache (kind TEXT, key TEXT, value TEXT, created REAL, accessed REAL, size INTEGER, PRIMARY KEY (kind, key))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return json.dumps(parts, separators=(',', ':'))
+
+    def get(self, kind: str, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM cache WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            if row is None: return None
+            if now - row[1] > self.ttls.get(kind, 0):
+                self._delete(kind, key); return None
+            self._conn.execute("UPDATE cache SET accessed = ? WHERE kind = ? AND key = ?", (now, kind, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def get_many(self, kind: str, keys: list) -> dict:
+        """Zoals get(), maar voor veel keys tegelijk; ontbrekende of verlopen keys worden weggelaten."""
+        now, found = time.time(), {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(f"SELECT key, value, created FROM cache WHERE kind = ? AND key IN ({placeholders})", (kind, *chunk)).fetchall()
+                for key, value, created in rows:
+                    if now - created <= self.ttls.get(kind, 0): found[key] = json.loads(value)
+            if found:
+                self._conn.executemany("UPDATE cache SET accessed = ? WHERE kind = ? AND key = ?", [(now, kind, key) for key in found])
+                self._conn.commit()
+        return found
+
+    def set(self, kind: str, key: str, value):
+        payload = json.dumps(value, separators=(',', ':'))
+        now = time.time()
+        with self._lock:
+            self._delete(kind, key, commit=False)
+            self._conn.execute("INSERT INTO cache VALUES (?, ?, ?, ?, ?, ?)", (kind, key, payload, now, now, len(payload)))
+            self._total_bytes += len(payload)
+            if self._total_bytes > self.max_bytes: self._evict()
+            self._conn.commit()
+
+    def get_or_fetch(self, kind: str, key: str, fetch, force_refresh: bool = False):
+        if not force_refresh:
+            cached = self.get(kind, key)
+            if cached is not None: return cached
+        value = fetch()
+        self.set(kind, key, value)
+        return value
+
+    def _delete(self, kind: str, key: str, commit: bool = True):
+        row = self._conn.execute("SELECT size FROM cache WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        if row is None: return
+        self._conn.execute("DELETE FROM cache WHERE kind = ? AND key = ?", (kind, key))
+        self._total_bytes -= row[0]
+        if commit: self._conn.commit()
+
+    def _evict(self):
+        # Verwijder de oudste entries (LRU) tot we onder 90% van het maximum zitten.
+        target = self.max_bytes * 0.9
+        for kind, key, size in self._conn.execute("SELECT kind, key, size FROM cache ORDER BY accessed").fetchall():
+            if self._total_bytes <= target: break
+            self._conn.execute("DELETE FROM cache WHERE kind = ? AND key = ?", (kind, key))
+            self._total_bytes -= size
+
+@st.cache_resource
+def get_scan_cache():
+    return ScanCache()
+
+# --- Lokale Corpus Index (SQLite FTS5) ---
+
+CORPUS_PATH = '.opportunity_corpus.sqlite3'
+
+class CorpusIndex:
+    """
+    Full-text index over alle posts en comments die de scanner ooit heeft opgehaald.
+
+    Elk document hoort bij de gebruiker wiens scan het ophaalde (ook private subreddits
+    komen zo in de index), en queries zien alleen de documenten van die gebruiker.
+
+    Gebruikt de FTS5 trigram-tokenizer (substring-matching, net als de scanner zelf)
+    als SQLite die ondersteunt. Kandidaten uit de index worden daarna door dezelfde
+    KeywordMatcher bevestigd, zodat lokale resultaten gelijk zijn aan een live scan.
+    """
+
+    def __init__(self, path: str = CORPUS_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(documents)")]
+        if columns and 'owner' not in columns:
+            # Oude index zonder eigenaar: niet aan een gebruiker toe te wijzen, dus opnieuw opbouwen.
+            self._conn.executescript("DROP TABLE IF EXISTS documents_fts; DROP TABLE documents;")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (rowid INTEGER PRIMARY KEY, owner TEXT, doc_id TEXT, type TEXT, subreddit TEXT, author TEXT, permalink TEXT, created_utc REAL, title TEXT, body TEXT, UNIQUE (owner, doc_id));
+            CREATE INDEX IF NOT EXISTS documents_subreddit ON documents (owner, subreddit COLLATE NOCASE);
+            CREATE TRIGGER IF NOT EXISTS documents_ai AFTER INSERT ON documents BEGIN
+                INSERT INTO documents_fts (rowid, body) VALUES (new.rowid, new.body);
+            END;
+            CREATE TRIGGER IF NOT EXISTS documents_ad AFTER DELETE ON documents BEGIN
+                INSERT INTO documents_fts (documents_fts, rowid, body) VALUES ('delete', old.rowid, old.body);
+            END;
+            CREATE TRIGGER IF NOT EXISTS documents_au AFTER UPDATE ON documents BEGIN
+                INSERT INTO documents_fts (documents_fts, rowid, body) VALUES ('delete', old.rowid, old.body);
+                INSERT INTO documents_fts (rowid, body) VALUES (new.rowid, new.body);
+            END;
+        """)
+        try:
+            self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(body, content='documents', content_rowid='rowid', tokenize='trigram')")
+            self.trigram = True
+        except sqlite3.OperationalError:
+            # Oudere SQLite zonder trigram: woord-tokens, de KeywordMatcher vangt de rest op.
+            self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(body, content='documents', content_rowid='rowid')")
+            self.trigram = False
+        self._conn.commit()
+
+    def add_posts(self, owner: str, posts: list):
+        rows = [(owner, f"t3_{p['id']}", 'Post', p['subreddit'], p['author'], p['permalink'], p['created_utc'], normalize_text(p['title']), normalize_text(f"{p['title']} {p['selftext']}")) for p in posts]
+        self._upsert(rows)
+
+    def add_comments(self, owner: str, subreddit_name: str, comments: list):
+        rows = [(owner, f"t1_{c['id']}", 'Comment', subreddit_name, c['author'], c['permalink'], c['created_utc'], None, normalize_text(c['body'])) for c in comments if c['body']]
+        self._upsert(rows)
+
+    def _upsert(self, rows: list):
+        if not rows: return
+        with self._lock:
+            self._conn.executemany("""
+                INSERT INTO documents (owner, doc_id, type, subreddit, author, permalink, created_utc, title, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (owner, doc_id) DO UPDATE SET author = excluded.author, title = excluded.title, body = excluded.body
+                WHERE body IS NOT excluded.body OR author IS NOT excluded.author
+            """, rows)
+            self._conn.commit()
+
+    def count(self, owner: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM documents WHERE owner = ?", (owner,)).fetchone()[0]
+
+    def _match_expression(self, matcher: KeywordMatcher):
+        variants = matcher.variants
+        # Trigram kan alleen termen van 3+ tekens zoeken; dan scannen we de (gefilterde) corpus volledig.
+        if not self.trigram or any(len(v) < 3 for v in variants): return None
+        return ' OR '.join('"' + v.replace('"', '""') + '"' for v in variants)
+
+    def query(self, owner: str, matcher: KeywordMatcher, subreddit_names: list = None) -> list:
+        """Draait de keyword matching tegen de lokale corpus van `owner` en geeft signals terug zoals een live scan."""
+        if not matcher: return []
+        expression = self._match_expression(matcher)
+        sql = "SELECT d.type, d.subreddit, d.author, d.permalink, d.title, d.body FROM documents d"
+        where, args = ["d.owner = ?"], [owner]
+        if expression:
+            sql += " JOIN documents_fts f ON f.rowid = d.rowid"
+            where.append("documents_fts MATCH ?"); args.append(expression)
+        if subreddit_names:
+            where.append(f"d.subreddit COLLATE NOCASE IN ({','.join('?' * len(subreddit_names))})"); args.extend(subreddit_names)
+        sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY d.subreddit COLLATE NOCASE, d.created_utc DESC"
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        signals = []
+        for doc_type, subreddit_name, author, permalink, title, body in rows:
+            if not author or author == '[deleted]' or body in ('[deleted]', '[removed]') or not permalink: continue
+            matched = matcher.match(body)
+            if matched:
+                signals.append({"Subreddit": subreddit_name, "Match": ', '.join(matched), "Type": doc_type, "Text": title if doc_type == 'Post' else body, "Author": author, "Link": f"https://reddit.com{permalink}"})
+        return signals
 
-# --- Zoekfuncties (beide met Cancel-logica) ---
+@st.cache_resource
+def get_corpus_index():
+    return CorpusIndex()
+
+# --- Reddit Data Bron (PRAW-objecten -> platte records, met cache) ---
+
+def _author_name(item):
+    author = getattr(item, 'author', None)
+    return author.name if author else None
+
+def _post_record(post) -> dict:
+    return {
+        'id': post.id, 'title': post.title, 'selftext': post.selftext, 'author': _author_name(post),
+        'permalink': post.permalink, 'subreddit': post.subreddit.display_name,
+        'score': post.score, 'num_comments': post.num_comments, 'created_utc': post.created_utc,
+    }
+
+def _comment_record(comment) -> dict:
+    return {
+        'id': comment.id, 'body': getattr(comment, 'body', ''), 'author': _author_name(comment),
+        'permalink': getattr(comment, 'permalink', None), 'score': getattr(comment, 'score', 0),
+        'created_utc': getattr(comment, 'created_utc', 0),
+    }
+
+class DataSource(abc.ABC):
+    """
+    Interface waar beide scans tegen werken. Alle methodes geven platte dicts terug
+    (zie _post_record en _comment_record), zodat een bron vervangen kan worden door
+    bv. een ReplaySource zonder dat de scanlogica verandert. Elke bron heeft een
+    `metrics` (ScanMetrics) waarin de scans hun fases timen. Een bron die niet alle
+    abstracte methodes implementeert faalt al bij het aanmaken.
+    """
+
+    metrics: ScanMetrics
+
+    @abc.abstractmethod
+    def top_posts(self, subreddit_name: str, time_filter: str, limit: int, fresh: bool = False) -> list:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def search_subreddits(self, query: str, limit: int) -> list:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def search_posts(self, query: str, limit: int) -> list:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def subreddit_info(self, names) -> dict:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iter_comments(self, post_id: str, limit: int, fresh: bool = False):
+        """
+        Lazy generator over de comments van een post (breadth-first), maximaal `limit`.
+        Een aanroeper die eerder stopt moet de generator sluiten (contextlib.closing),
+        zodat de bron kan vastleggen wat er al doorlopen is.
+        """
+        raise NotImplementedError
+
+    def comments(self, post_id: str, limit: int, fresh: bool = False) -> list:
+        with contextlib.closing(self.iter_comments(post_id, limit, fresh)) as comments:
+            return list(comments)
+
+def iter_comment_forest(forest):
+    """
+    Breadth-first over een PRAW CommentForest, in dezelfde volgorde als
+    replace_more(limit=0) + list(), maar zonder de hele boom eerst plat te slaan.
+    """
+    queue = deque(forest)
+    while queue:
+        comment = queue.popleft()
+        if isinstance(comment, MoreComments): continue
+        yield comment
+        queue.extend(comment.replies)
+
+class RedditSource(DataSource):
+    """
+    Haalt listings, zoekresultaten en comment trees op als platte dicts, via de ScanCache.
+
+    Met `reddit_lease` (bv. RedditClientPool.lease voor één gebruiker) leent elke call
+    een eigen PRAW-client, zodat parallelle workers nooit een client delen; anders wordt
+    de meegegeven `reddit` client gebruikt. `force_refresh` slaat het lezen
+    uit de cache over maar ververst de cache wel. Met een `corpus` wordt alles wat van
+    Reddit opgehaald wordt ook in de lokale full-text index van `owner` geschreven. Elke call wordt
+    getimed als fase met de naam van zijn cache-soort.
+    """
+
+    def __init__(self, reddit=None, cache: ScanCache = None, reddit_lease=None, force_refresh: bool = False, corpus: CorpusIndex = None, metrics: ScanMetrics = None, owner: str = None):
+        self._reddit = reddit
+        self._reddit_lease = reddit_lease
+        self.cache = cache
+        self.force_refresh = force_refresh
+        self.corpus = corpus
+        self.owner = owner
+        self.metrics = metrics or ScanMetrics()
+
+    @contextlib.contextmanager
+    def _client(self):
+        if self._reddit_lease is None:
+            yield self._reddit
+        else:
+            with self._reddit_lease() as reddit: yield reddit
+
+    def _cached(self, kind: str, key: tuple, fetch, fresh: bool = False):
+        fetched = []
+        def tracked_fetch():
+            fetched.append(True)
+            return fetch()
+        with self.metrics.phase(kind):
+            if self.cache is None: return fetch()
+            value = self.cache.get_or_fetch(kind, ScanCache.make_key(*key), tracked_fetch, self.force_refresh or fresh)
+        if not fetched: self.metrics.record_cache_hit()
+        return value
+
+    def top_posts(self, subreddit_name: str, time_filter: str, limit: int, fresh: bool = False) -> list:
+        def fetch():
+            with self._client() as reddit:
+                records = [_post_record(p) for p in reddit.subreddit(subreddit_name).top(time_filter=time_filter, limit=limit)]
+            if self.corpus is not None: self.corpus.add_posts(self.owner, records)
+            return records
+        return self._cached('listing', (self.owner, subreddit_name.lower(), time_filter, limit), fetch, fresh)
+
+    def search_subreddits(self, query: str, limit: int) -> list:
+        def fetch():
+            with self._client() as reddit:
+                return [{'display_name': s.display_name, 'subscribers': s.subscribers} for s in reddit.subreddits.search(query, limit=limit)]
+        return self._cached('subreddit_search', (query.lower(), limit), fetch)
+
+    def search_posts(self, query: str, limit: int) -> list:
+        def fetch():
+            with self._client() as reddit:
+                records = [_post_record(p) for p in reddit.subreddit("all").search(query, sort="relevance", time_filter="month", limit=limit)]
+            if self.corpus is not None: self.corpus.add_posts(self.owner, records)
+            return records
+        return self._cached('post_search', (self.owner, query.lower(), limit), fetch)
+
+    def subreddit_info(self, names) -> dict:
+        """
+        Metadata (subscribers, over18) per subreddit, op lowercase naam.
+
+        Eerst uit de cache; de rest wordt in bulk opgehaald via /api/info (100 per
+        request) in plaats van één lazy `about`-request per post. Subreddits die niet
+        terugkomen (privé, gebanned) ontbreken in het resultaat en worden niet gecached.
+        """
+        wanted = {name.lower(): name for name in names}
+        info = {}
+        with self.metrics.phase('subreddit_info'):
+            if self.cache is not None and not self.force_refresh:
+                keys = {ScanCache.make_key(k): k for k in wanted}
+                info = {keys[key]: value for key, value in self.cache.get_many('subreddit_info', list(keys)).items()}
+                self.metrics.record_cache_hit(len(info))
+            missing = [wanted[k] for k in wanted if k not in info]
+            for start in range(0, len(missing), 100):
+                batch = missing[start:start + 100]
+                with self._client() as reddit:
+                    fetched = {s.display_name.lower(): {'display_name': s.display_name, 'subscribers': s.subscribers, 'over18': s.over18} for s in reddit.info(subreddits=batch)}
+                for name, record in fetched.items():
+                    info[name] = record
+                    if self.cache is not None: self.cache.set('subreddit_info', ScanCache.make_key(name), record)
+        return {k: info[k] for k in wanted if k in info}
+
+    def iter_comments(self, post_id: str, limit: int, fresh: bool = False):
+        """
+        Comments van een post (breadth-first, zoals comments.list()), lazy tot `limit`.
+
+        De boom wordt pas omgezet naarmate de aanroeper verder leest. De cache bewaart wat
+        doorlopen is, met `complete` als de hele geladen boom gezien is; een gedeeltelijke
+        entry is alleen bruikbaar voor een even kleine of kleinere `limit`. Met `fresh`
+        wordt de cache voor deze ene comment tree overgeslagen (en ververst).
+        """
+        if limit <= 0: return
+        key = ScanCache.make_key(self.owner, post_id)
+        cached = None
+        if self.cache is not None and not (self.force_refresh or fresh):
+            with self.metrics.phase('comments'):
+                cached = self.cache.get('comments', key)
+            if isinstance(cached, list): cached = {'records': cached, 'complete': True}
+            if cached is not None and (cached['complete'] or len(cached['records']) >= limit):
+                self.metrics.record_cache_hit()
+                yield from cached['records'][:limit]
+                return
+        with self.metrics.phase('comments'), self._client() as reddit:
+            submission = reddit.submission(id=post_id)
+            forest = submission.comments  # één request voor de hele geladen boom
+        records, complete = [], False
+        try:
+            for comment in iter_comment_forest(forest):
+                if len(records) >= limit: break
+                records.append(_comment_record(comment))
+                yield records[-1]
+            else:
+                complete = True
+        finally:
+            if self.cache is not None and (cached is None or len(records) > len(cached['records']) or complete):
+                self.cache.set('comments', key, {'records': records, 'complete': complete})
+            if self.corpus is not None and records: self.corpus.add_comments(self.owner, submission.subreddit.display_name, records)
+
+# --- Replay & Synthetische Data (offline scans en benchmarks) ---
+
+def _not_found(url: str):
+    response = requests.models.Response()
+    response.status_code, response.url = 404, url
+    return NotFound(response)
+
+class ReplaySource(DataSource):
+    """
+    Offline DataSource die een opgenomen of gegenereerde dataset serveert.
 
-def find_communities_hybrid(_reddit, search_queries: tuple, direct_limit: int, post_limit: int, comment_limit: int):
-    aggregated_results = {}
-    progress_bar = st.session_state.get('progress_bar_placeholder')
+    Dataset-formaat: {'subreddits': {naam: {'subscribers', 'over18', 'posts': [post records]}},
+    'comments': {post_id: [comment records]}}. Elke "API-call" wacht `latency` seconden en
+    wordt geteld in `calls`, net als het aantal opgeleverde posts/comments in `items`.
+    """
+
+    def __init__(self, dataset: dict, latency: float = 0.0, metrics: ScanMetrics = None):
+        self.dataset = dataset
+        self.latency = latency
+        self.metrics = metrics or ScanMetrics()
+        self.calls = {}
+        self.items = 0
+        self._lock = threading.Lock()
+        self._subreddits = {name.lower(): data for name, data in dataset['subreddits'].items()}
+        self._names = {name.lower(): name for name in dataset['subreddits']}
+
+    @classmethod
+    def load(cls, path: str, latency: float = 0.0):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            return cls(json.load(f), latency)
+
+    @property
+    def api_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _call(self, kind: str, items: int = 0, count: int = 1):
+        with self.metrics.phase(kind):
+            with self._lock:
+                self.calls[kind] = self.calls.get(kind, 0) + count
+                self.items += items
+            for _ in range(count): self.metrics.record_request(200)
+            if self.latency: time.sleep(self.latency * count)
+
+    def top_posts(self, subreddit_name: str, time_filter: str, limit: int, fresh: bool = False) -> list:
+        data = self._subreddits.get(subreddit_name.lower())
+        if data is None:
+            self._call('listing'); raise _not_found(f"/r/{subreddit_name}/top")
+        posts = sorted(data['posts'], key=lambda p: p['score'], reverse=True)[:limit]
+        self._call('listing', len(posts), max(1, math.ceil(limit / 100)))
+        return posts
+
+    def search_subreddits(self, query: str, limit: int) -> list:
+        terms = [t for t in query.lower().split() if t]
+        found = [{'display_name': self._names[key], 'subscribers': data['subscribers']} for key, data in self._subreddits.items() if any(t in key for t in terms)][:limit]
+        self._call('subreddit_search')
+        return found
+
+    def search_posts(self, query: str, limit: int) -> list:
+        needle = normalize_text(query).lower()
+        found = [p for data in self._subreddits.values() for p in data['posts'] if needle in f"{p['title']} {p['selftext']}".lower()]
+        found = sorted(found, key=lambda p: p['score'], reverse=True)[:limit]
+        self._call('post_search', len(found), max(1, math.ceil(limit / 100)))
+        return found
+
+    def subreddit_info(self, names) -> dict:
+        names = list(names)
+        info = {}
+        for name in names:
+            data = self._subreddits.get(name.lower())
+            if data is None: continue
+            info[name.lower()] = {'display_name': self._names.get(name.lower(), name), 'subscribers': data['subscribers'], 'over18': data['over18']}
+        self._call('subreddit_info', 0, max(1, math.ceil(len(names) / 100)))
+        return info
+
+    def iter_comments(self, post_id: str, limit: int, fresh: bool = False):
+        if limit <= 0: return
+        self._call('comments')
+        for comment in self.dataset['comments'].get(post_id, [])[:limit]:
+            with self._lock: self.items += 1
+            yield comment
+
+class RecordingSource(DataSource):
+    """
+    Wrapper om een andere DataSource die alles wat hij oplevert bewaart als replay-dataset,
+    bv. RecordingSource(RedditSource(reddit)) tijdens een echte scan, gevolgd door save().
+    Een eerdere opname (`dataset`) kan aangevuld worden, bv. bij een hervatte job.
+    """
+
+    def __init__(self, inner: DataSource, dataset: dict = None):
+        self.inner = inner
+        self.metrics = inner.metrics
+        self.dataset = dataset or {'subreddits': {}, 'comments': {}}
+        self._lock = threading.Lock()
+
+    def _add_posts(self, posts: list):
+        with self._lock:
+            for post in posts:
+                sub = self.dataset['subreddits'].setdefault(post['subreddit'], {'subscribers': None, 'over18': False, 'posts': []})
+                if all(p['id'] != post['id'] for p in sub['posts']): sub['posts'].append(post)
+
+    def top_posts(self, subreddit_name: str, time_filter: str, limit: int, fresh: bool = False) -> list:
+        posts = self.inner.top_posts(subreddit_name, time_filter, limit, fresh)
+        self._add_posts(posts)
+        return posts
+
+    def search_subreddits(self, query: str, limit: int) -> list:
+        found = self.inner.search_subreddits(query, limit)
+        with self._lock:
+            for sub in found:
+                self.dataset['subreddits'].setdefault(sub['display_name'], {'subscribers': sub['subscribers'], 'over18': False, 'posts': []})
+        return found
+
+    def search_posts(self, query: str, limit: int) -> list:
+        posts = self.inner.search_posts(query, limit)
+        self._add_posts(posts)
+        return posts
+
+    def subreddit_info(self, names) -> dict:
+        info = self.inner.subreddit_info(names)
+        with self._lock:
+            for record in info.values():
+                sub = self.dataset['subreddits'].setdefault(record['display_name'], {'posts': []})
+                sub['subscribers'], sub['over18'] = record['subscribers'], record['over18']
+        return info
+
+    def iter_comments(self, post_id: str, limit: int, fresh: bool = False):
+        comments = []
+        try:
+            with contextlib.closing(self.inner.iter_comments(post_id, limit, fresh)) as inner:
+                for comment in inner:
+                    comments.append(comment)
+                    yield comment
+        finally:
+            with self._lock:
+                if len(comments) > len(self.dataset['comments'].get(post_id, [])): self.dataset['comments'][post_id] = comments
+
+    def save(self, path: str):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wt', encoding='utf-8') as f:
+            json.dump(self.dataset, f)
+
+SYNTHETIC_VOCABULARY = (
+    "the a to and of i it for is that you this with my on have but just was so be not are can what if "
+    "any like get do about one would or how at your they all more time people know think some work "
+    "make want need good really from need business app tool customer price month year product idea team"
+).split()
+
+def generate_synthetic_dataset(subreddits: int = 5, posts_per_subreddit: int = 100, comments_per_post: int = 500, keywords=(), hit_rate: float = 0.02, words_per_comment: int = 40, seed: int = 0) -> dict:
+    """
+    Genereert een reproduceerbare dataset in het ReplaySource-formaat. Een fractie
+    `hit_rate` van alle teksten bevat een willekeurig keyword uit `keywords`.
+    """
+    rng = random.Random(seed)
+    def text(words):
+        tokens = rng.choices(SYNTHETIC_VOCABULARY, k=words)
+        if keywords and rng.random() < hit_rate: tokens.insert(rng.randrange(len(tokens) + 1), rng.choice(keywords))
+        return ' '.join(tokens)
+
+    dataset = {'subreddits': {}, 'comments': {}}
+    now = time.time()
+    for s in range(subreddits):
+        name = f"synthetic{s}"
+        posts = []
+        for p in range(posts_per_subreddit):
+            post_id = f"s{s}p{p}"
+            posts.append({
+                'id': post_id, 'title': text(10), 'selftext': text(words_per_comment * 2), 'author': f"user{rng.randrange(10000)}",
+                'permalink': f"/r/{name}/comments/{post_id}/", 'subreddit': name,
+                'score': rng.randrange(10000), 'num_comments': comments_per_post, 'created_utc': now - rng.randrange(30 * 86400),
+            })
+            dataset['comments'][post_id] = [{
+                'id': f"{post_id}c{c}", 'body': text(words_per_comment), 'author': f"user{rng.randrange(10000)}",
+                'permalink': f"/r/{name}/comments/{post_id}/_/{post_id}c{c}/", 'score': rng.randrange(500), 'created_utc': now - rng.randrange(30 * 86400),
+            } for c in range(comments_per_post)]
+        dataset['subreddits'][name] = {'subscribers': rng.randrange(1000, 1000000), 'over18': False, 'posts': posts}
+    return dataset
+
+# --- Zoekfuncties (generators met Cancel-logica) ---
+#
+# Beide scans zijn generators die events opleveren, zodat een achtergrond-job de
+# resultaten kan streamen en per unit een checkpoint kan vastleggen:
+#   ('progress', fractie, tekst)
+#   ('rows', unit, seq, rows)   rows horen bij checkpoint `unit`; `seq` bepaalt de volgorde
+# Units in `completed` zijn al eerder verwerkt en worden overgeslagen (resume).
+
+class CommentBudget:
+    """
+    Globaal comment-budget voor één scan.
+
+    allocate() verdeelt `total` comments over alle posts van de scan, eerst over de posts
+    met de meeste kans op een match (score en aantal comments), elk maximaal
+    `comment_limit` en niet meer dan de post aan comments heeft. De verdeling hangt
+    alleen van de posts af, zodat een hervatte scan dezelfde verdeling krijgt.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.allocation = {}
+
+    @staticmethod
+    def priority(post: dict) -> float:
+        return math.log1p(max(post['score'], 0)) + math.log1p(post['num_comments'])
+
+    def allocate(self, posts: list, comment_limit: int):
+        remaining = self.total
+        ranked = sorted(range(len(posts)), key=lambda i: (-self.priority(posts[i]), i))
+        for i in ranked:
+            post = posts[i]
+            share = min(comment_limit, post['num_comments'], remaining)
+            self.allocation[post['id']] = share
+            remaining -= share
+
+    def limit_for(self, post_id: str, comment_limit: int) -> int:
+        return min(comment_limit, self.allocation.get(post_id, 0))
+
+def _community_hit(name: str, members, found_via: str, queries) -> dict:
+    return {'Community': name, 'Members': members, 'Found Via': found_via, 'Queries': sorted(queries)}
+
+def iter_community_discovery(source, search_queries: tuple, direct_limit: int, post_limit: int, comment_limit: int, is_cancelled=None, completed=frozenset(), comment_budget: int = None, warn=None):
+    """
+    Zoekt communities in twee fases. Eerst worden voor alle queries de directe en
+    post-zoekopdrachten uitgevoerd, waarbij posts op id ontdubbeld worden. Daarna
+    wordt de comment tree van elke unieke post één keer lazy doorlopen en getest
+    tegen alle queries die die post opleverden, tot ze allemaal gematcht zijn.
+    Met `comment_budget` geldt een totaal aantal comments voor de hele zoekopdracht.
+    Posts uit communities waarvan de metadata (NSFW) niet bekend is, vallen af.
+    """
+    is_cancelled = is_cancelled or (lambda: False)
+    warn = warn or (lambda message: None)
+    posts_by_id, queries_by_post = {}, {}
+
+    # --- Fase 1: alle zoekopdrachten ---
     for i, query in enumerate(search_queries):
-        if st.session_state.get('community_cancel_scan'): break
-        if progress_bar:
-            progress_bar.progress(i / len(search_queries), text=f"Searching for: '{query}'...")
+        if is_cancelled(): return
+        yield ('progress', 0.5 * i / len(search_queries), f"Searching for: '{query}'...")
+        unit = f"search:{query}"
+        if unit not in completed:
+            hits = []
+            try:
+                for sub in source.search_subreddits(query, direct_limit):
+                    if sub['display_name'].startswith('u_'): continue
+                    hits.append(_community_hit(sub['display_name'], sub['subscribers'], FOUND_VIA_DIRECT, [query]))
+            except PRAWException: pass
+            if is_cancelled(): return
+            yield ('rows', unit, (0, i), hits)
+        # De posts zijn ook na een resume nodig voor fase 2 (en komen dan uit de cache).
         try:
-            for sub in _reddit.subreddits.search(query, limit=direct_limit):
-                if st.session_state.get('community_cancel_scan'): break
-                if sub.display_name.startswith('u_'): continue
-                if sub.display_name not in aggregated_results: aggregated_results[sub.display_name] = {'Community': sub.display_name, 'Members': sub.subscribers, 'Found Via': set()}
-                aggregated_results[sub.display_name]['Found Via'].add(FOUND_VIA_DIRECT)
+            for post in source.search_posts(query, post_limit):
+                if post['subreddit'].startswith('u_'): continue
+                posts_by_id.setdefault(post['id'], post)
+                queries_by_post.setdefault(post['id'], []).append(query)
         except PRAWException: pass
-        if st.session_state.get('community_cancel_scan'): break
+
+    # --- Subreddit-metadata in bulk, voor alle unieke communities tegelijk ---
+    if posts_by_id and not is_cancelled():
         try:
-            for post in _reddit.subreddit("all").search(query, sort="relevance", time_filter="month", limit=post_limit):
-                if st.session_state.get('community_cancel_scan'): break
-                if post.subreddit.display_name.startswith('u_') or post.subreddit.over18: continue
-                community_name = post.subreddit.display_name
-                if community_name not in aggregated_results: aggregated_results[community_name] = {'Community': community_name, 'Members': post.subreddit.subscribers, 'Found Via': set()}
-                aggregated_results[community_name]['Found Via'].add(FOUND_VIA_POST)
-                if comment_limit > 0:
-                    try:
-                        post.comments.replace_more(limit=0)
-                        for comment in post.comments.list()[:comment_limit]:
-                            if st.session_state.get('community_cancel_scan'): break
-                            if hasattr(comment, 'body') and query.lower() in comment.body.lower():
-                                aggregated_results[community_name]['Found Via'].add(FOUND_VIA_COMMENT); break
-                    except Exception: continue
-        except PRAWException: pass
-    if progress_bar: progress_bar.progress(1.0, text="Finalizing results...")
-    if not aggregated_results: return pd.DataFrame()
-    final_list = [{'Community': f"r/{name}", **data} for name, data in aggregated_results.items()]
-    df = pd.DataFrame(final_list)
-    if df.empty: return df
-    df['Relevance Score'] = df['Found Via'].apply(calculate_relevance_score)
-    df['Found Via'] = df['Found Via'].apply(lambda s: ', '.join(sorted(list(s))))
-    df['Community Link'] = df['Community'].apply(lambda name: f"https://www.reddit.com/{name}")
-    df['Top Posts (Month)'] = df['Community'].apply(lambda name: f"https://www.reddit.com/{name}/top/?t=month")
-    df = df.sort_values(by=['Relevance Score', 'Members'], ascending=[False, False])
-    return df[['Community', 'Relevance Score', 'Found Via', 'Members', 'Community Link', 'Top Posts (Month)']].reset_index(drop=True)
-
-def find_buying_signals(_reddit, subreddit_name: str, keywords: list, time_filter: str, post_limit: int, comment_limit: int):
+            subreddit_info = source.subreddit_info({post['subreddit'] for post in posts_by_id.values()})
+        except Exception as e:
+            warn(f"Could not check which communities are NSFW; skipping communities found via posts: {e}")
+            subreddit_info = {}
+        hits = []
+        for post_id, post in list(posts_by_id.items()):
+            # Alleen communities waarvan vaststaat dat ze niet NSFW zijn; onbekend telt als niet gecontroleerd.
+            info = subreddit_info.get(post['subreddit'].lower())
+            if info is None or info['over18']:
+                del posts_by_id[post_id]; continue
+            hits.append(_community_hit(post['subreddit'], info['subscribers'], FOUND_VIA_POST, set(queries_by_post[post_id])))
+        if 'posts' not in completed: yield ('rows', 'posts', (1, 0), hits)
+
+    # --- Fase 2: elke comment tree één keer, alle queries tegelijk ---
+    if comment_limit > 0 and posts_by_id:
+        query_matcher = KeywordMatcher(search_queries)
+        budget = None
+        if comment_budget:
+            budget = CommentBudget(comment_budget)
+            budget.allocate(list(posts_by_id.values()), comment_limit)
+        for j, (post_id, post) in enumerate(posts_by_id.items()):
+            if is_cancelled(): return
+            unit = f"comments:{post_id}"
+            if unit in completed: continue
+            yield ('progress', 0.5 + 0.5 * j / len(posts_by_id), f"Checking comments ({j + 1}/{len(posts_by_id)})...")
+            open_queries = set(queries_by_post[post_id])
+            limit = budget.limit_for(post_id, comment_limit) if budget else comment_limit
+            try:
+                with contextlib.closing(source.iter_comments(post_id, limit)) as comments, source.metrics.phase('matching'):
+                    for comment in comments:
+                        open_queries -= set(query_matcher.match(normalize_text(comment['body'])))
+                        if is_cancelled() or not open_queries: break
+            except Exception: pass
+            if is_cancelled(): return
+            matched_queries = set(queries_by_post[post_id]) - open_queries
+            yield ('rows', unit, (2, j), [_community_hit(post['subreddit'], None, FOUND_VIA_COMMENT, matched_queries)] if matched_queries else [])
+
+    yield ('progress', 1.0, "Finalizing results...")
+
+COMMUNITY_TOP_QUERIES = 3
+
+def _query_hit_counts(hits: list, community_codes: np.ndarray):
     """
-    Vindt buying signals op een robuuste manier, filtert verwijderde content,
-    en ondersteunt een cancel-operatie.
+    Telt hits per (community-code, query) met integer-codes en np.unique. Geeft community-codes,
+    querynamen en aantallen terug, per community gesorteerd op aantal (aflopend) en dan query.
+    Hits zonder queries (jobs van vóór deze kolom) tellen niet mee.
+    """
+    per_hit = np.array([len(hit.get('Queries', ())) for hit in hits], dtype=np.int64)
+    query_codes, query_names = pd.factorize(np.array([query for hit in hits for query in hit.get('Queries', ())], dtype=object))
+    if not len(query_codes): return np.array([], dtype=np.int64), np.array([], dtype=object), np.array([], dtype=np.int64)
+    pairs, counts = np.unique(np.repeat(community_codes, per_hit) * len(query_names) + query_codes, return_counts=True)
+    communities, queries = np.divmod(pairs, len(query_names))
+    query_rank = np.argsort(np.argsort(np.asarray(query_names, dtype=str)))
+    order = np.lexsort((query_rank[queries], -counts, communities))
+    return communities[order], np.asarray(query_names, dtype=object)[queries[order]], counts[order]
+
+def community_query_hits(hits: list) -> pd.DataFrame:
+    """Aantal hits per community en query, in lange vorm (bv. voor een export of een heatmap)."""
+    codes, names = pd.factorize(np.array([hit['Community'] for hit in hits], dtype=object))
+    communities, queries, counts = _query_hit_counts(hits, codes)
+    return pd.DataFrame({'Community': "r/" + np.asarray(names, dtype=object)[communities], 'Query': queries, 'Hits': counts})
+
+def build_communities_df(hits: list):
     """
+    Voegt de community-hits samen tot de resultatentabel, gesorteerd op relevantie.
+
+    Alles is kolomgewijs: communities worden gefactoriseerd naar integer-codes, de bronnen
+    per community OR'd tot een bitmasker (score en label via RELEVANCE_BY_MASK en
+    FOUND_VIA_LABELS), en hits en queries per community geteld met bincount. Bij een gelijke
+    score wint de community die door meer queries en vaker gevonden is.
+    """
+    if not hits: return pd.DataFrame()
+    codes, names = pd.factorize(np.array([hit['Community'] for hit in hits], dtype=object))
+    names = "r/" + np.asarray(names, dtype=object)
+    n = len(names)
+    masks = np.zeros(n, dtype=np.int64)
+    np.bitwise_or.at(masks, codes, np.array([FOUND_VIA_BITS[hit['Found Via']] for hit in hits], dtype=np.int64))
+    # Members: de eerste bekende waarde per community (comment-hits hebben er geen).
+    members = np.array([np.nan if hit['Members'] is None else hit['Members'] for hit in hits], dtype=float)
+    known = np.flatnonzero(~np.isnan(members))
+    member_communities, first_known = np.unique(codes[known], return_index=True)
+    first_members = np.full(n, np.nan)
+    first_members[member_communities] = members[known[first_known]]
+
+    query_communities, queries, query_counts = _query_hit_counts(hits, codes)
+    rank = np.arange(len(query_communities)) - np.searchsorted(query_communities, query_communities)
+    top_labels = np.full(n, '', dtype=object)
+    for community, query, count in zip(query_communities[rank < COMMUNITY_TOP_QUERIES], queries[rank < COMMUNITY_TOP_QUERIES], query_counts[rank < COMMUNITY_TOP_QUERIES]):
+        top_labels[community] += f"{', ' if top_labels[community] else ''}{query} ({count})"
+
+    base_urls = "https://www.reddit.com/" + names
+    df = pd.DataFrame({
+        'Community': names,
+        'Relevance Score': RELEVANCE_BY_MASK[masks],
+        'Found Via': FOUND_VIA_LABELS[masks],
+        'Queries Matched': np.bincount(query_communities, minlength=n),
+        'Hits': np.bincount(codes, minlength=n),
+        'Top Queries': top_labels,
+        'Members': pd.array(first_members, dtype="Int64"),
+        'Community Link': base_urls,
+        'Top Posts (Month)': base_urls + "/top/?t=month",
+    })
+    df = df.sort_values(by=['Relevance Score', 'Queries Matched', 'Hits', 'Members'], ascending=False, kind='stable')
+    return df.reset_index(drop=True)
+
+def find_communities_hybrid(source, search_queries: tuple, direct_limit: int, post_limit: int, comment_limit: int, is_cancelled=None, comment_budget: int = None):
+    """Synchrone variant van iter_community_discovery; geeft direct de resultatentabel terug."""
+    hits = [hit for event in iter_community_discovery(source, search_queries, direct_limit, post_limit, comment_limit, is_cancelled, comment_budget=comment_budget) if event[0] == 'rows' for hit in event[3]]
+    return build_communities_df(hits)
+
+def _post_signal(post: dict, subreddit_name: str, matcher: KeywordMatcher):
+    """Geeft een signal-dict terug als de post zelf een keyword bevat, anders None."""
+    if not (post['author'] and post['author'] != '[deleted]'): return None
+    post_title = normalize_text(post['title'])
+    post_selftext = normalize_text(post['selftext'])
+    matched_post_keywords = matcher.match(f"{post_title} {post_selftext}")
+    if not matched_post_keywords: return None
+    return {
+        "Subreddit": subreddit_name, 
+        "Match": ', '.join(matched_post_keywords), 
+        "Type": "Post", 
+        "Text": post_title, 
+        "Author": post['author'], 
+        "Link": f"https://reddit.com{post['permalink']}"
+    }
+
+def _comment_signals(comments: list, subreddit_name: str, matcher: KeywordMatcher, is_cancelled, warn):
+    """Geeft alle comments met een keyword-match terug als signal-dicts."""
     signals = []
-    subreddit = _reddit.subreddit(subreddit_name)
-    
+    for comment in comments:
+        if is_cancelled(): break
+        
+        try:
+            # 1. STRIKTE CONTROLE: Zorg dat de comment en auteur bestaan en niet verwijderd zijn.
+            if not (comment['body'] and comment['author'] and comment['permalink']):
+                continue
+            if comment['body'] in ['[deleted]', '[removed]'] or comment['author'] == '[deleted]':
+                continue
+
+            # 2. TEKSTOPSCHONING: Verwijder overtollige witruimte voor een schone output.
+            comment_text = normalize_text(comment['body'])
+            if not comment_text: # Sla over als de comment na opschonen leeg is.
+                continue
+            
+            # Zoek alle keywords in één pass over de opgeschoonde tekst
+            matched_comment_keywords = matcher.match(comment_text)
+            if matched_comment_keywords:
+                signals.append({
+                    "Subreddit": subreddit_name, 
+                    "Match": ', '.join(matched_comment_keywords), 
+                    "Type": "Comment", 
+                    "Text": comment_text, # Gebruik de opgeschoonde tekst
+                    "Author": comment['author'], 
+                    "Link": f"https://reddit.com{comment['permalink']}"
+                })
+        
+        except Exception as e:
+            # 3. VANGNET: Sla deze specifieke comment over als er toch een onverwachte fout is.
+            warn(f"Skipped one comment in r/{subreddit_name} due to data issue: {e}")
+            continue
+    return signals
+
+def _scan_post(source, post: dict, subreddit_name: str, matcher: KeywordMatcher, comment_limit: int, is_cancelled, warn, watermark=None, budget: CommentBudget = None):
+    """
+    Matcht één post en (tot `comment_limit`, of minder volgens het comment-budget) zijn
+    comments. Met een watermark worden alleen nieuwe comments en nog niet eerder gemelde
+    signals teruggegeven.
+
+    Geeft (signals, checkpoint) terug. `checkpoint` legt de watermark van de post vast en
+    mag pas aangeroepen worden nadat de signals gecommit zijn; hij is None als er geen
+    watermark is of de post niet gescand is (fout bij de comments, cancel). Heeft het
+    budget de post ingekort, dan worden alleen de gemelde signals vastgelegd.
+    """
+    signals = []
+    # Een door het budget ingekorte post krijgt geen watermark, zodat een latere scan de rest alsnog leest.
+    complete, fetched = True, True
+    if budget:
+        budgeted_limit = budget.limit_for(post['id'], comment_limit)
+        complete = budgeted_limit >= min(comment_limit, post['num_comments'])
+        comment_limit = budgeted_limit
+
+    # --- Post verwerking ---
     try:
-        top_posts = subreddit.top(time_filter=time_filter, limit=post_limit)
+        with source.metrics.phase('matching'): post_signal = _post_signal(post, subreddit_name, matcher)
+        if post_signal and not (watermark and watermark.is_emitted(post_signal['Link'])): signals.append(post_signal)
     except Exception as e:
-        st.warning(f"Could not fetch posts for r/{subreddit_name}: {e}")
-        return []
+        warn(f"Skipped a post in r/{subreddit_name} due to an error: {e}")
+        return signals, None
 
-    for post in top_posts:
-        if st.session_state.get('signal_cancel_scan'): break
+    # --- Comment verwerking ---
+    comments = []
+    if comment_limit > 0:
+        try:
+            # Incrementeel: altijd een verse comment tree, anders mist de watermark nieuwe comments.
+            comments = source.comments(post['id'], comment_limit, fresh=watermark is not None)
+            if watermark: comments = watermark.new_comments(post['id'], comments)
+            with source.metrics.phase('matching'): comment_signals = _comment_signals(comments, subreddit_name, matcher, is_cancelled, warn)
+            signals.extend(signal for signal in comment_signals if not (watermark and watermark.is_emitted(signal['Link'])))
+        except Exception as e:
+            warn(f"Could not load comments for a post in r/{subreddit_name}: {e}")
+            fetched = False
+    if not (watermark and fetched) or is_cancelled(): return signals, None
+    return signals, partial(watermark.record, post, comments, signals, complete)
+
+def iter_buying_signals(source, subreddit_name: str, matcher: KeywordMatcher, time_filter: str, post_limit: int, comment_limit: int, is_cancelled, warn, skip_post_ids=frozenset(), watermark=None, budget: CommentBudget = None, top_posts: list = None):
+    """
+    Scant één subreddit en levert per verwerkte post (post_index, post_id, signals) op.
 
+    NotFound/Forbidden/BadRequest op de listing worden doorgegeven aan de aanroeper.
+    Posts die sinds de watermark niet veranderd zijn worden niet opnieuw opgehaald.
+    Een al opgehaalde listing (bv. voor het comment-budget) kan als `top_posts` mee.
+    """
+    if top_posts is None:
         try:
-            # --- Post verwerking ---
-            if post.author and post.author.name != '[deleted]':
-                post_title = re.sub(r'\s+', ' ', post.title).strip()
-                post_selftext = re.sub(r'\s+', ' ', post.selftext).strip()
-                post_content = f"{post_title.lower()} {post_selftext.lower()}"
-                
-                matched_post_keywords = {keyword for keyword in keywords if keyword.lower() in post_content}
-                if matched_post_keywords:
-                    signals.append({
-                        "Subreddit": subreddit_name, 
-                        "Match": ', '.join(matched_post_keywords), 
-                        "Type": "Post", 
-                        "Text": post_title, 
-                        "Author": post.author.name, 
-                        "Link": f"https://reddit.com{post.permalink}"
-                    })
+            # Incrementeel: de listing moet vers zijn, anders worden gewijzigde posts als ongewijzigd gezien.
+            top_posts = source.top_posts(subreddit_name, time_filter, post_limit, fresh=watermark is not None)
+        except (NotFound, Forbidden, BadRequest):
+            raise
         except Exception as e:
-            st.warning(f"Skipped a post in r/{subreddit_name} due to an error: {e}")
+            warn(f"Could not fetch posts for r/{subreddit_name}: {e}")
+            return
+
+    for post_index, post in enumerate(top_posts):
+        if is_cancelled(): return
+        if post['id'] in skip_post_ids: continue
+        if watermark and watermark.is_unchanged(post):
+            yield post_index, post['id'], []
             continue
+        signals, checkpoint = _scan_post(source, post, subreddit_name, matcher, comment_limit, is_cancelled, warn, watermark, budget)
+        if is_cancelled(): return
+        yield post_index, post['id'], signals
+        # Pas na de yield: de aanroeper heeft de rijen dan verwerkt (bij een job: gecommit).
+        if checkpoint: checkpoint()
 
-        # --- Comment verwerking ---
-        if comment_limit > 0:
-            try:
-                post.comments.replace_more(limit=0)
-                for comment in post.comments.list()[:comment_limit]:
-                    if st.session_state.get('signal_cancel_scan'): break
-                    
-                    try:
-                        # 1. STRIKTE CONTROLE: Zorg dat de comment en auteur bestaan en niet verwijderd zijn.
-                        if not (hasattr(comment, 'body') and hasattr(comment, 'author') and comment.author and hasattr(comment, 'permalink')):
-                            continue
-                        if comment.body in ['[deleted]', '[removed]'] or comment.author.name == '[deleted]':
-                            continue
+def find_buying_signals(source, subreddit_name: str, keywords, time_filter: str, post_limit: int, comment_limit: int, is_cancelled=None, warn=None):
+    """
+    Vindt buying signals op een robuuste manier, filtert verwijderde content,
+    en ondersteunt een cancel-operatie.
+
+    `keywords` mag een lijst zijn of een vooraf gecompileerde KeywordMatcher, zodat
+    een scan over meerdere subreddits het patroon maar één keer opbouwt.
+    """
+    matcher = keywords if isinstance(keywords, KeywordMatcher) else KeywordMatcher(keywords)
+    is_cancelled = is_cancelled or (lambda: False)
+    warn = warn or (lambda message: None)
+    return [signal for _, _, signals in iter_buying_signals(source, subreddit_name, matcher, time_filter, post_limit, comment_limit, is_cancelled, warn) for signal in signals]
+
+def _completed_posts(completed, subreddit_name: str) -> set:
+    prefix = f"r/{subreddit_name}/"
+    return {unit[len(prefix):] for unit in completed if unit.startswith(prefix)}
+
+def _fetch_listing(source, subreddit_name: str, time_filter: str, post_limit: int, warn, watermark_for):
+    """Listing plus watermark van één subreddit; bij een fout een warning en ([], None)."""
+    try:
+        watermark = watermark_for(subreddit_name)
+        return source.top_posts(subreddit_name, time_filter, post_limit, fresh=watermark is not None), watermark
+    except (NotFound, Forbidden, BadRequest) as e:
+        warn(f"Skipped r/{subreddit_name}: {e.__class__.__name__}")
+    except Exception as e:
+        warn(f"Could not fetch posts for r/{subreddit_name}: {e}")
+    return [], None
+
+def _comment_budget_for(listings: list, comment_limit: int, comment_budget: int) -> CommentBudget:
+    """Verdeelt het comment-budget over alle posts van alle listings, behalve ongewijzigde (incrementeel)."""
+    budget = CommentBudget(comment_budget)
+    budget.allocate([post for posts, watermark in listings for post in posts if not (watermark and watermark.is_unchanged(post))], comment_limit)
+    return budget
+
+def iter_scan_signals(source, subreddit_names: list, matcher: KeywordMatcher, time_filter: str, post_limit: int, comment_limit: int, max_workers: int = 1, is_cancelled=None, warn=None, completed=frozenset(), watermark_for=None, comment_budget: int = None):
+    """
+    Scant een lijst subreddits en levert scan-events op (zie boven).
+
+    Checkpoints: "r/<sub>/<post_id>" na elke volledig verwerkte post (inclusief comments)
+    en "r/<sub>" na een volledige subreddit. `seq` is (subreddit_index, post_index), zodat
+    het eindresultaat dezelfde volgorde heeft als een sequentiële scan.
+    `watermark_for(subreddit_name)` levert voor een incrementele scan de SubredditWatermark.
+    Met `comment_budget` worden eerst alle listings opgehaald, zodat het budget over de
+    posts van alle subreddits verdeeld kan worden.
+    """
+    is_cancelled = is_cancelled or (lambda: False)
+    warn = warn or (lambda message: None)
+    watermark_for = watermark_for or (lambda subreddit_name: None)
+    if max_workers > 1:
+        yield from _iter_scan_signals_parallel(source, subreddit_names, matcher, time_filter, post_limit, comment_limit, max_workers, is_cancelled, warn, completed, watermark_for, comment_budget)
+        return
+    listings, budget = None, None
+    if comment_budget:
+        yield ('progress', 0.0, "Ranking posts for the comment budget...")
+        listings = []
+        for name in subreddit_names:
+            if is_cancelled(): return
+            listings.append(_fetch_listing(source, name, time_filter, post_limit, warn, watermark_for))
+        budget = _comment_budget_for(listings, comment_limit, comment_budget)
+    for sub_index, sub_name in enumerate(subreddit_names):
+        if is_cancelled(): return
+        yield ('progress', sub_index / len(subreddit_names), f"Scanning r/{sub_name}...")
+        if f"r/{sub_name}" in completed: continue
+        top_posts, watermark = listings[sub_index] if listings else (None, watermark_for(sub_name))
+        try:
+            for post_index, post_id, signals in iter_buying_signals(source, sub_name, matcher, time_filter, post_limit, comment_limit, is_cancelled, warn, _completed_posts(completed, sub_name), watermark, budget, top_posts):
+                yield ('rows', f"r/{sub_name}/{post_id}", (sub_index, post_index), signals)
+        except (NotFound, Forbidden, BadRequest) as e:
+            warn(f"Skipped r/{sub_name}: {e.__class__.__name__}")
+        if is_cancelled(): return
+        yield ('rows', f"r/{sub_name}", (sub_index, -1), [])
+    yield ('progress', 1.0, "Finalizing results...")
+
+def _iter_scan_signals_parallel(source, subreddit_names: list, matcher: KeywordMatcher, time_filter: str, post_limit: int, comment_limit: int, max_workers: int, is_cancelled, warn, completed, watermark_for, comment_budget=None):
+    """
+    Parallelle variant van iter_scan_signals.
+
+    Listings en comment trees worden op een begrensde worker pool opgehaald. De
+    `source` moet per call een eigen Reddit-client lenen (RedditSource met
+    `reddit_lease`, want PRAW is niet thread-safe); die clients delen één
+    RateLimitBudget. Events komen binnen in de volgorde waarin ze klaar zijn.
+    """
+    stop = threading.Event()
 
-                        # 2. TEKSTOPSCHONING: Verwijder overtollige witruimte voor een schone output.
-                        comment_text = re.sub(r'\s+', ' ', comment.body).strip()
-                        if not comment_text: # Sla over als de comment na opschonen leeg is.
+    budget = None
+
+    def fetch_listing(sub_name):
+        if stop.is_set(): return [], None
+        return _fetch_listing(source, sub_name, time_filter, post_limit, warn, watermark_for)
+
+    def scan_post(sub_name, post, watermark):
+        if stop.is_set(): return None
+        result = _scan_post(source, post, sub_name, matcher, comment_limit, stop.is_set, warn, watermark, budget)
+        return None if stop.is_set() else result
+
+    total, subs_done, remaining = len(subreddit_names), 0, {}
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="signal-scan")
+    try:
+        futures, listings = {}, None
+        if comment_budget:
+            # Eerst alle listings (parallel), zodat het budget over alle subreddits verdeeld wordt.
+            yield ('progress', 0.0, "Ranking posts for the comment budget...")
+            listing_futures = [pool.submit(fetch_listing, name) for name in subreddit_names]
+            pending = set(listing_futures)
+            while pending:
+                _, pending = wait(pending, timeout=0.25)
+                if is_cancelled():
+                    stop.set(); return
+            listings = [future.result() for future in listing_futures]
+            budget = _comment_budget_for(listings, comment_limit, comment_budget)
+        for i, name in enumerate(subreddit_names):
+            if f"r/{name}" in completed: subs_done += 1
+            elif listings:
+                future = Future()
+                future.set_result(listings[i])
+                futures[future] = (i, None, None)
+            else: futures[pool.submit(fetch_listing, name)] = (i, None, None)
+        yield ('progress', subs_done / total, "Scanning subreddits in parallel...")
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+            if is_cancelled():
+                stop.set(); return
+            for future in done:
+                sub_index, post_index, post_id = futures.pop(future)
+                sub_name = subreddit_names[sub_index]
+                if post_index is None:
+                    posts, watermark = future.result()
+                    skip = _completed_posts(completed, sub_name)
+                    remaining[sub_index] = 0
+                    for j, post in enumerate(posts):
+                        if post['id'] in skip: continue
+                        if watermark and watermark.is_unchanged(post):
+                            yield ('rows', f"r/{sub_name}/{post['id']}", (sub_index, j), [])
                             continue
-                        
-                        # Zoek naar keywords in de opgeschoonde tekst
-                        for keyword in keywords:
-                            if keyword.lower() in comment_text.lower():
-                                signals.append({
-                                    "Subreddit": subreddit_name, 
-                                    "Match": keyword, 
-                                    "Type": "Comment", 
-                                    "Text": comment_text, # Gebruik de opgeschoonde tekst
-                                    "Author": comment.author.name, 
-                                    "Link": f"https://reddit.com{comment.permalink}"
-                                })
-                                break # Ga naar de volgende comment zodra een match is gevonden
-                    
-                    except Exception as e:
-                        # 3. VANGNET: Sla deze specifieke comment over als er toch een onverwachte fout is.
-                        st.warning(f"Skipped one comment in r/{subreddit_name} due to data issue: {e}")
-                        continue
-            except Exception as e:
-                 st.warning(f"Could not load comments for a post in r/{subreddit_name}: {e}")
+                        post_future = pool.submit(scan_post, sub_name, post, watermark)
+                        futures[post_future] = (sub_index, j, post['id'])
+                        pending.add(post_future)
+                        remaining[sub_index] += 1
+                else:
+                    result = future.result()
+                    if result is None: continue
+                    signals, checkpoint = result
+                    yield ('rows', f"r/{sub_name}/{post_id}", (sub_index, post_index), signals)
+                    # De watermark pas vastleggen nu de rijen gecommit zijn, niet in de worker.
+                    if checkpoint: checkpoint()
+                    remaining[sub_index] -= 1
+                if remaining[sub_index] == 0:
+                    subs_done += 1
+                    yield ('rows', f"r/{sub_name}", (sub_index, -1), [])
+                    yield ('progress', subs_done / total, f"Scanned r/{sub_name} ({subs_done}/{total})...")
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+    yield ('progress', 1.0, "Finalizing results...")
 
-    return signals
+# --- Incrementele scans (watermarks per subreddit) ---
+
+HISTORY_PATH = '.opportunity_history.sqlite3'
+
+class SubredditWatermark:
+    """
+    Stand van de vorige scans voor één subreddit en keywordset: per post het aantal
+    comments en de nieuwste comment-timestamp, plus alle al gemelde signal-links.
+    """
+
+    def __init__(self, history, scope: str, posts: dict, emitted: set):
+        self._history = history
+        self.scope = scope
+        self.posts = posts
+        self.emitted = emitted
+        self._lock = threading.Lock()
+
+    def is_unchanged(self, post: dict) -> bool:
+        seen = self.posts.get(post['id'])
+        return seen is not None and seen[0] == post['num_comments']
+
+    def new_comments(self, post_id: str, comments: list) -> list:
+        seen = self.posts.get(post_id)
+        if seen is None: return comments
+        return [comment for comment in comments if comment['created_utc'] > seen[1]]
+
+    def is_emitted(self, link: str) -> bool:
+        return link in self.emitted
+
+    def record(self, post: dict, comments: list, signals: list, complete: bool = True):
+        """Met `complete=False` (niet alle comments gelezen) worden alleen de signals vastgelegd."""
+        if not complete:
+            with self._lock: self.emitted.update(signal['Link'] for signal in signals)
+            self._history.record_signals(self.scope, signals)
+            return
+        last_comment_utc = max([c['created_utc'] for c in comments] + [self.posts.get(post['id'], (0, 0))[1]])
+        with self._lock:
+            self.posts[post['id']] = (post['num_comments'], last_comment_utc)
+            self.emitted.update(signal['Link'] for signal in signals)
+        self._history.record(self.scope, post['id'], post['num_comments'], last_comment_utc, signals)
+
+class ScanHistory:
+    """
+    Persistente watermarks en historische resultaten voor incrementele opportunity scans.
+
+    Een scope is (gebruiker, subreddit, keywordset): met andere keywords moeten oude
+    posts immers opnieuw gematcht worden.
+    """
+
+    def __init__(self, path: str = HISTORY_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS watermarks (scope TEXT, post_id TEXT, num_comments INTEGER, last_comment_utc REAL, PRIMARY KEY (scope, post_id));
+            CREATE TABLE IF NOT EXISTS signals (scope TEXT, link TEXT, payload TEXT, first_seen REAL, PRIMARY KEY (scope, link));
+        """)
+        self._conn.commit()
+
+    @staticmethod
+    def scope(owner: str, subreddit_name: str, matcher: KeywordMatcher) -> str:
+        return f"{owner}|{subreddit_name.lower()}|{matcher.fingerprint}"
+
+    def watermark(self, owner: str, subreddit_name: str, matcher: KeywordMatcher) -> SubredditWatermark:
+        scope = self.scope(owner, subreddit_name, matcher)
+        with self._lock:
+            posts = {row[0]: (row[1], row[2]) for row in self._conn.execute("SELECT post_id, num_comments, last_comment_utc FROM watermarks WHERE scope = ?", (scope,))}
+            emitted = {row[0] for row in self._conn.execute("SELECT link FROM signals WHERE scope = ?", (scope,))}
+        return SubredditWatermark(self, scope, posts, emitted)
+
+    def record(self, scope: str, post_id: str, num_comments: int, last_comment_utc: float, signals: list):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)", (scope, post_id, num_comments, last_comment_utc))
+            self._conn.executemany("INSERT OR IGNORE INTO signals VALUES (?, ?, ?, ?)", [(scope, s['Link'], json.dumps(s), now) for s in signals])
+            self._conn.commit()
+
+    def record_signals(self, scope: str, signals: list):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO signals VALUES (?, ?, ?, ?)", [(scope, s['Link'], json.dumps(s), now) for s in signals])
+            self._conn.commit()
+
+    def signals(self, owner: str, subreddit_names: list, matcher: KeywordMatcher) -> list:
+        """Alle ooit gemelde signals voor deze subreddits en keywordset, oudste eerst."""
+        scopes = [self.scope(owner, name, matcher) for name in subreddit_names]
+        placeholders = ','.join('?' * len(scopes))
+        with self._lock:
+            return [json.loads(row[0]) for row in self._conn.execute(f"SELECT payload FROM signals WHERE scope IN ({placeholders}) ORDER BY first_seen, rowid", scopes)]
+
+@st.cache_resource
+def get_scan_history():
+    return ScanHistory()
+
+# --- Achtergrond-jobs (streaming resultaten + checkpoint/resume) ---
+
+JOBS_PATH = '.opportunity_jobs.sqlite3'
+RECORDINGS_DIR = '.opportunity_recordings'
+
+def job_recording_path(job_id: str) -> str:
+    """Replay-dataset van een job die met opname draaide (RecordingSource), voor benchmark.py --dataset."""
+    return os.path.join(RECORDINGS_DIR, f"{job_id}.json.gz")
+
+class JobStore:
+    """
+    Persistente opslag voor scan-jobs: parameters, status, voortgang, resultaatrijen,
+    warnings en afgeronde checkpoint-units. Rijen en hun checkpoint worden in één
+    transactie geschreven, zodat een hervatte job geen dubbele resultaten oplevert.
+    """
+
+    def __init__(self, path: str = JOBS_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, owner TEXT, params TEXT, status TEXT, error TEXT, progress REAL, progress_text TEXT, created REAL, updated REAL);
+            CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, kind, created);
+            CREATE TABLE IF NOT EXISTS job_rows (job_id TEXT, seq_major INTEGER, seq_minor INTEGER, payload TEXT);
+            CREATE INDEX IF NOT EXISTS job_rows_job ON job_rows (job_id, seq_major, seq_minor);
+            CREATE TABLE IF NOT EXISTS job_units (job_id TEXT, unit TEXT, PRIMARY KEY (job_id, unit));
+            CREATE TABLE IF NOT EXISTS job_messages (job_id TEXT, message TEXT);
+            CREATE TABLE IF NOT EXISTS job_metrics (job_id TEXT PRIMARY KEY, metrics TEXT);
+        """)
+        self._conn.commit()
+
+    def create(self, kind: str, owner: str, params: dict) -> str:
+        job_id, now = uuid.uuid4().hex, time.time()
+        with self._lock:
+            self._conn.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, 'running', NULL, 0, '', ?, ?)", (job_id, kind, owner, json.dumps(params), now, now))
+            self._conn.commit()
+        return job_id
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._conn.execute("SELECT id, kind, owner, params, status, error, progress, progress_text, created, updated FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None: return None
+        keys = ('id', 'kind', 'owner', 'params', 'status', 'error', 'progress', 'progress_text', 'created', 'updated')
+        job = dict(zip(keys, row))
+        job['params'] = json.loads(job['params'])
+        return job
+
+    def latest(self, owner: str, kind: str):
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM jobs WHERE owner = ? AND kind = ? ORDER BY created DESC LIMIT 1", (owner, kind)).fetchone()
+        return self.get(row[0]) if row else None
+
+    def set_status(self, job_id: str, status: str, error: str = None):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?", (status, error, time.time(), job_id))
+            self._conn.commit()
+
+    def set_progress(self, job_id: str, progress: float, text: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET progress = ?, progress_text = ?, updated = ? WHERE id = ?", (progress, text, time.time(), job_id))
+            self._conn.commit()
+
+    def commit_unit(self, job_id: str, unit: str, seq: tuple, rows: list):
+        with self._lock:
+            if unit is not None:
+                if self._conn.execute("SELECT 1 FROM job_units WHERE job_id = ? AND unit = ?", (job_id, unit)).fetchone(): return
+                self._conn.execute("INSERT INTO job_units VALUES (?, ?)", (job_id, unit))
+            self._conn.executemany("INSERT INTO job_rows VALUES (?, ?, ?, ?)", [(job_id, seq[0], seq[1], json.dumps(row)) for row in rows])
+            self._conn.commit()
+
+    def completed_units(self, job_id: str) -> set:
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT unit FROM job_units WHERE job_id = ?", (job_id,))}
+
+    def rows(self, job_id: str, offset: int = 0, limit: int = -1) -> list:
+        with self._lock:
+            return [json.loads(row[0]) for row in self._conn.execute("SELECT payload FROM job_rows WHERE job_id = ? ORDER BY seq_major, seq_minor, rowid LIMIT ? OFFSET ?", (job_id, limit, offset))]
+
+    def count_rows(self, job_id: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM job_rows WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def add_message(self, job_id: str, message: str):
+        with self._lock:
+            self._conn.execute("INSERT INTO job_messages VALUES (?, ?)", (job_id, message))
+            self._conn.commit()
+
+    def messages(self, job_id: str) -> list:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT message FROM job_messages WHERE job_id = ? ORDER BY rowid", (job_id,))]
+
+    def set_metrics(self, job_id: str, metrics: dict):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO job_metrics VALUES (?, ?)", (job_id, json.dumps(metrics)))
+            self._conn.commit()
+
+    def metrics(self, job_id: str):
+        with self._lock:
+            row = self._conn.execute("SELECT metrics FROM job_metrics WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+def _community_job(runner, source, job: dict, is_cancelled, warn, completed):
+    params = job['params']
+    return iter_community_discovery(source, tuple(params['queries']), params['direct'], params['post'], params['comment'], is_cancelled, completed, params.get('comment_budget'), warn)
+
+def _signal_job(runner, source, job: dict, is_cancelled, warn, completed):
+    params = job['params']
+    matcher = KeywordMatcher(params['keywords'])
+    watermark_for = partial(runner.history.watermark, job['owner'], matcher=matcher) if params.get('incremental') else None
+    return iter_scan_signals(source, params['subreddits'], matcher, params['time_filter'], params['post_limit'], params['comment_limit'], params['workers'], is_cancelled, warn, completed, watermark_for, params.get('comment_budget'))
+
+JOB_KINDS = {'communities': _community_job, 'signals': _signal_job}
+
+class JobRunner:
+    """
+    Draait scan-jobs in een achtergrond-thread, los van de Streamlit script-run.
+
+    De job schrijft zijn events naar de JobStore; de UI pollt die store. Een job met
+    status 'running' zonder levende thread (bv. na een herstart van de server) is
+    onderbroken en kan met resume() verder waar hij gebleven was. De ScanMetrics van de
+    source worden bij elke voortgangsstap in de store gezet; na een resume beschrijven
+    ze alleen de hervatte run.
+    """
+
+    def __init__(self, store: JobStore, history: ScanHistory):
+        self.store = store
+        self.history = history
+        self._lock = threading.Lock()
+        self._threads, self._cancel_events, self._metrics = {}, {}, {}
+
+    def start(self, kind: str, owner: str, params: dict, source) -> str:
+        job_id = self.store.create(kind, owner, params)
+        self._launch(job_id, source)
+        return job_id
+
+    def resume(self, job_id: str, source):
+        self.store.set_status(job_id, 'running')
+        self._launch(job_id, source)
+
+    def is_running(self, job_id: str) -> bool:
+        thread = self._threads.get(job_id)
+        return bool(thread and thread.is_alive())
+
+    def is_interrupted(self, job: dict) -> bool:
+        return job['status'] == 'running' and not self.is_running(job['id'])
+
+    def cancel(self, job_id: str):
+        event = self._cancel_events.get(job_id)
+        if event: event.set()
+
+    def report(self, job_id: str):
+        """Run-report van een job: de job zelf plus live (lopend) of opgeslagen metrics."""
+        job = self.store.get(job_id)
+        metrics = self._metrics[job_id].snapshot() if self.is_running(job_id) else self.store.metrics(job_id)
+        if job is None or metrics is None: return None
+        return {'job': {key: job[key] for key in ('id', 'kind', 'status', 'created', 'updated', 'params')}, 'metrics': metrics}
+
+    def _launch(self, job_id: str, source):
+        with self._lock:
+            if self.is_running(job_id): return
+            cancel_event = threading.Event()
+            thread = threading.Thread(target=self._run, args=(job_id, source, cancel_event), name=f"scan-job-{job_id[:8]}", daemon=True)
+            self._threads[job_id], self._cancel_events[job_id], self._metrics[job_id] = thread, cancel_event, source.metrics
+        thread.start()
+
+    def _run(self, job_id: str, source, cancel_event: threading.Event):
+        job = self.store.get(job_id)
+        warn = partial(self.store.add_message, job_id)
+        try:
+            events = JOB_KINDS[job['kind']](self, source, job, cancel_event.is_set, warn, self.store.completed_units(job_id))
+            for event in events:
+                if event[0] == 'progress':
+                    self.store.set_progress(job_id, event[1], event[2])
+                    self.store.set_metrics(job_id, source.metrics.snapshot())
+                else: self.store.commit_unit(job_id, *event[1:])
+            self.store.set_metrics(job_id, source.metrics.snapshot())
+            self.store.set_status(job_id, 'cancelled' if cancel_event.is_set() else 'done')
+        except Exception as e:
+            self.store.set_metrics(job_id, source.metrics.snapshot())
+            self.store.set_status(job_id, 'failed', error=f"{e.__class__.__name__}: {e}")
+        finally:
+            # Ook een geannuleerde of mislukte scan levert een bruikbare (gedeeltelijke) opname op.
+            if isinstance(source, RecordingSource):
+                try:
+                    os.makedirs(RECORDINGS_DIR, exist_ok=True)
+                    source.save(job_recording_path(job_id))
+                except OSError as e:
+                    warn(f"Could not save the recording: {e}")
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner(JobStore(), get_scan_history())
+
+# --- Resultaten (kolomopslag, paginering en streaming export) ---
+
+SIGNAL_COLUMNS = ['Subreddit', 'Match', 'Type', 'Text', 'Author', 'Link']
+SIGNAL_CATEGORICAL = {'Subreddit', 'Match', 'Type'}
+SIGNAL_SCHEMA = pa.schema([(name, pa.dictionary(pa.int32(), pa.string()) if name in SIGNAL_CATEGORICAL else pa.string()) for name in SIGNAL_COLUMNS])
+RESULTS_BATCH_ROWS = 10000
+
+def signal_batch(rows: list) -> pa.RecordBatch:
+    """Zet signal-dicts om naar een Arrow record batch met categorische Subreddit/Match/Type."""
+    arrays = []
+    for name in SIGNAL_COLUMNS:
+        array = pa.array([row.get(name) for row in rows], pa.string())
+        arrays.append(array.dictionary_encode() if name in SIGNAL_CATEGORICAL else array)
+    return pa.RecordBatch.from_arrays(arrays, schema=SIGNAL_SCHEMA)
+
+class SignalResults:
+    """
+    Signal-resultaten als Arrow record batches, zonder alles als één DataFrame te laden.
+
+    Job-resultaten worden per pagina of per batch uit de JobStore gelezen; kleine
+    resultaten in het geheugen (lokale corpus, gemergde historie) worden één keer
+    als compacte Arrow-tabel bewaard. Exports worden batch voor batch naar een
+    tijdelijk bestand geschreven.
+    """
+
+    def __init__(self, count: int, read_rows):
+        self._count = count
+        self._read_rows = read_rows  # (offset, limit) -> pa.Table
+
+    @classmethod
+    def from_job(cls, store, job_id: str):
+        return cls(store.count_rows(job_id), lambda offset, limit: pa.Table.from_batches([signal_batch(store.rows(job_id, offset, limit))]))
+
+    @classmethod
+    def from_rows(cls, rows: list):
+        table = pa.Table.from_batches([signal_batch(rows[start:start + RESULTS_BATCH_ROWS]) for start in range(0, len(rows), RESULTS_BATCH_ROWS)], schema=SIGNAL_SCHEMA)
+        return cls(table.num_rows, table.slice)
+
+    def __len__(self):
+        return self._count
+
+    def page(self, number: int, page_size: int) -> pd.DataFrame:
+        return self._read_rows(number * page_size, page_size).to_pandas()
+
+    def batches(self, batch_size: int = RESULTS_BATCH_ROWS):
+        for offset in range(0, self._count, batch_size):
+            yield from self._read_rows(offset, batch_size).to_batches()
+
+    def export(self, fmt: str):
+        """Schrijft alle batches naar een tijdelijk bestand in `fmt` en geeft het ruwe (ongebufferde) bestand terug."""
+        file = tempfile.TemporaryFile()
+        EXPORT_FORMATS[fmt][2](self.batches(), file)
+        file.seek(0)
+        return file.detach()
+
+def _write_csv(batches, file):
+    with pa_csv.CSVWriter(file, SIGNAL_SCHEMA) as writer:
+        for batch in batches: writer.write_batch(batch)
+
+def _write_parquet(batches, file):
+    with pa_parquet.ParquetWriter(file, SIGNAL_SCHEMA) as writer:
+        for batch in batches: writer.write_batch(batch)
+
+def _xlsx_cell(sheet, value):
+    """Tekst-cel zonder tekens die Excel weigert; tekst die met '=' begint blijft tekst en wordt geen formule."""
+    if value is None: return None
+    cell = WriteOnlyCell(sheet, ILLEGAL_CHARACTERS_RE.sub('', value)[:32767])
+    cell.data_type = 's'
+    return cell
+
+def _write_xlsx(batches, file):
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Opportunities")
+    sheet.append(SIGNAL_COLUMNS)
+    for batch in batches:
+        for row in zip(*(column.to_pylist() for column in batch.columns)): sheet.append([_xlsx_cell(sheet, value) for value in row])
+    workbook.save(file)
+
+EXPORT_FORMATS = {
+    'csv': ("CSV", 'text/csv', _write_csv),
+    'parquet': ("Parquet", 'application/vnd.apache.parquet', _write_parquet),
+    'xlsx': ("Excel", 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', _write_xlsx),
+}
 
 # --- UI Functies (Login) ---
 def show_password_form():
@@ -170,16 +1813,112 @@ def show_reddit_login_page():
     st.info("ℹ️ You will be redirected to Reddit to grant permission. This app never sees your password.")
 
 # --- Hoofdapplicatie ---
-def show_main_app(reddit):
-    # State variabelen voor beide taken
-    if 'community_scan_running' not in st.session_state: st.session_state.community_scan_running = False
-    if 'community_cancel_scan' not in st.session_state: st.session_state.community_cancel_scan = False
-    if 'community_scan_was_cancelled' not in st.session_state: st.session_state.community_scan_was_cancelled = False
-    if 'signal_scan_running' not in st.session_state: st.session_state.signal_scan_running = False
-    if 'signal_cancel_scan' not in st.session_state: st.session_state.signal_cancel_scan = False
-    if 'signal_scan_was_cancelled' not in st.session_state: st.session_state.signal_scan_was_cancelled = False
-    
-    is_any_scan_running = st.session_state.community_scan_running or st.session_state.signal_scan_running
+def _job_source(reddit_lease, owner: str, force_refresh: bool = False, record: bool = False, job_id: str = None):
+    source = RedditSource(cache=get_scan_cache(), reddit_lease=reddit_lease, force_refresh=force_refresh, corpus=get_corpus_index(), owner=owner)
+    if not record: return source
+    # Bij een resume vult de opname de bestaande aan.
+    path = job_recording_path(job_id) if job_id else None
+    return RecordingSource(source, ReplaySource.load(path).dataset if path and os.path.exists(path) else None)
+
+def _session_job(runner: JobRunner, state_key: str, kind: str):
+    if state_key not in st.session_state:
+        # Na een browser refresh of websocket-drop: koppel opnieuw aan de laatste job, ook als die
+        # al klaar, geannuleerd of mislukt is, zodat zijn resultaten en status zichtbaar blijven.
+        latest = runner.store.latest(st.session_state.username, kind)
+        if latest is None: return None
+        st.session_state[state_key] = latest['id']
+    return runner.store.get(st.session_state[state_key])
+
+def _job_results(runner: JobRunner, job: dict):
+    """Communities als (kleine) DataFrame; signals als SignalResults die per pagina gelezen worden."""
+    if job['kind'] == 'communities': return build_communities_df(runner.store.rows(job['id']))
+    return SignalResults.from_job(runner.store, job['id'])
+
+PHASE_LABELS = {
+    'listing': "Listing fetches",
+    'comments': "Comment trees",
+    'subreddit_info': "Subreddit metadata",
+    'subreddit_search': "Subreddit search",
+    'post_search': "Post search",
+    'matching': "Keyword matching",
+}
+
+def show_scan_metrics(report: dict, export: bool = False):
+    """Instrumentatiepaneel: request-tellers, rate-limit headroom en tijd per fase."""
+    metrics = report['metrics']
+    c1, c2, c3, c4, c5 = st.columns(5)
+    c1.metric("API requests", metrics['requests'], help=f"{metrics['cache_hits']} answered from cache")
+    c2.metric("Data", f"{metrics['bytes'] / 2**20:.1f} MB")
+    c3.metric("Retries / 429s", f"{metrics['retries']} / {metrics['rate_limited']}")
+    remaining = metrics['ratelimit_remaining']
+    c4.metric("Rate limit left", "–" if remaining is None else int(remaining))
+    c5.metric("Resets in", "–" if metrics['ratelimit_reset_s'] is None else f"{metrics['ratelimit_reset_s']:.0f}s")
+    phases = pd.DataFrame([{'Phase': PHASE_LABELS.get(name, name), 'Calls': stats['calls'], 'Seconds': stats['seconds']} for name, stats in metrics['phases'].items()])
+    if not phases.empty:
+        phases = phases.sort_values('Seconds', ascending=False)
+        phases['Share'] = phases['Seconds'] / max(phases['Seconds'].sum(), 1e-9)
+        st.dataframe(phases, use_container_width=True, hide_index=True, column_config={'Share': st.column_config.ProgressColumn("Share", format="percent", min_value=0, max_value=1)})
+    st.caption(f"Elapsed: {metrics['elapsed_s']:.1f}s. Phase times are summed over parallel workers.")
+    if export:
+        job_id = report['job']['id']
+        c1, c2 = st.columns(2)
+        c1.download_button("📊 Download run report (JSON)", json.dumps(report, indent=2), f"scan_report_{job_id[:8]}.json", 'application/json', key=f"report_json_{job_id}", use_container_width=True)
+        c2.download_button("📊 Download run report (CSV)", pd.DataFrame(metrics_report_rows(report)).to_csv(index=False).encode('utf-8'), f"scan_report_{job_id[:8]}.csv", 'text/csv', key=f"report_csv_{job_id}", use_container_width=True)
+
+RESULTS_PAGE_SIZE = 500
+
+def show_signal_results(results: SignalResults, key: str, file_stem: str):
+    """Toont signal-resultaten per pagina; de exports worden pas bij een klik gestreamd naar een bestand."""
+    pages = max(math.ceil(len(results) / RESULTS_PAGE_SIZE), 1)
+    page = st.number_input(f"Page (of {pages}, {RESULTS_PAGE_SIZE} rows each)", 1, pages, 1, key=f"page_{key}") if pages > 1 else 1
+    st.dataframe(results.page(page - 1, RESULTS_PAGE_SIZE), use_container_width=True, hide_index=True)
+    for column, (fmt, (label, mime, _)) in zip(st.columns(len(EXPORT_FORMATS)), EXPORT_FORMATS.items()):
+        column.download_button(f"📥 Download as {label}", partial(results.export, fmt), f"{file_stem}.{fmt}", mime, key=f"export_{fmt}_{key}", use_container_width=True)
+
+@st.fragment(run_every=1.0)
+def show_live_job(runner: JobRunner, job_id: str, cancel_label: str):
+    """Pollt de JobStore en toont voortgang en de resultaten tot nu toe."""
+    if not runner.is_running(job_id): st.rerun()
+    job = runner.store.get(job_id)
+    st.progress(min(job['progress'] or 0.0, 1.0), text=job['progress_text'] or "Starting scan...")
+    report = runner.report(job_id)
+    if report: show_scan_metrics(report)
+    if st.button(cancel_label, key=f"cancel_{job_id}", use_container_width=True):
+        runner.cancel(job_id)
+    partial_results = _job_results(runner, job)
+    if len(partial_results):
+        if job['kind'] == 'signals':
+            st.caption(f"{len(partial_results)} results so far (showing the first {min(len(partial_results), RESULTS_PAGE_SIZE)})...")
+            st.dataframe(partial_results.page(0, RESULTS_PAGE_SIZE), use_container_width=True, hide_index=True)
+        else:
+            st.caption(f"{len(partial_results)} results so far...")
+            st.dataframe(partial_results, use_container_width=True, hide_index=True)
+
+def show_job_status(runner: JobRunner, job: dict, label: str, reddit_lease):
+    """Toont de eindstatus van een niet-lopende job, met een resume-knop als hij onderbroken is."""
+    if runner.is_interrupted(job):
+        st.warning(f"⏸️ The previous {label} was interrupted. You can resume where it stopped.")
+        if st.button(f"▶️ Resume {label}", key=f"resume_{job['id']}", use_container_width=True):
+            runner.resume(job['id'], _job_source(reddit_lease, job['owner'], job['params'].get('force_refresh', False), job['params'].get('record', False), job['id'])); st.rerun()
+    elif job['status'] == 'cancelled':
+        st.warning(f"️️{label.capitalize()} was cancelled by the user. Showing partial results.")
+    elif job['status'] == 'failed':
+        st.error(f"{label.capitalize()} failed: {job['error']}")
+    for message in runner.store.messages(job['id']): st.warning(message)
+    recording = job_recording_path(job['id'])
+    if os.path.exists(recording):
+        st.download_button("🎞️ Download recording (replay with benchmark.py --dataset)", partial(open, recording, 'rb'), f"recording_{job['id'][:8]}.json.gz", 'application/gzip', key=f"recording_{job['id']}", use_container_width=True)
+    report = runner.report(job['id'])
+    if report:
+        with st.expander("📊 Scan instrumentation"): show_scan_metrics(report, export=True)
+
+def show_main_app(reddit_lease):
+    runner = get_job_runner()
+    community_job = _session_job(runner, 'community_job_id', 'communities')
+    signal_job = _session_job(runner, 'signal_job_id', 'signals')
+    is_community_scan_running = community_job is not None and runner.is_running(community_job['id'])
+    is_signal_scan_running = signal_job is not None and runner.is_running(signal_job['id'])
+    is_any_scan_running = is_community_scan_running or is_signal_scan_running
 
     col1, col2 = st.columns([0.85, 0.15])
     with col1:
@@ -187,17 +1926,19 @@ def show_main_app(reddit):
         st.markdown(f"Logged in as **u/{st.session_state.username}**.")
     with col2:
         if st.button("Logout", use_container_width=True, disabled=is_any_scan_running):
-            st.session_state.clear(); st.rerun()
+            get_reddit_client_pool().discard(st.session_state["refresh_token"]); st.session_state.clear(); st.rerun()
 
     # --- Deel 1: Communities Vinden ---
     st.header("1. Discover Communities")
-    is_community_scan_running = st.session_state.community_scan_running
     with st.expander("⚙️ Advanced Search Settings"):
         st.markdown("Control the trade-off between search speed and thoroughness.")
         c1, c2, c3 = st.columns(3)
         direct_limit = c1.slider("Direct Search Depth", 0, 50, 10, help="How many communities to find based on name/description. Quick but less precise.", disabled=is_community_scan_running)
         post_limit = c2.slider("Post Search Depth", 0, 50, 25, help="How many posts to analyze. Finds communities where your topic is actively discussed.", disabled=is_community_scan_running)
         comment_limit = c3.slider("Comment Search Depth", 0, 50, 20, help="How many comments *per post* to analyze. Deepest (and slowest) search for finding hidden user pain points.", disabled=is_community_scan_running)
+        community_comment_budget = st.number_input("Total comment budget", 0, 100000, 0, 100, help="Maximum number of comments checked in the whole search, spent first on the most active posts. 0 means no limit.", disabled=is_community_scan_running)
+        community_force_refresh = st.toggle("♻️ Force refresh", value=False, key="community_force_refresh_toggle", help="Ignore cached Reddit results and fetch everything again.", disabled=is_community_scan_running)
+        community_record = st.toggle("🎞️ Record for offline replay", value=False, key="community_record_toggle", help="Save everything this search fetches as a replay dataset for benchmark.py --dataset.", disabled=is_community_scan_running)
     with st.form(key='community_search_form'):
         search_queries_input = st.text_area("Keywords (one per line)", placeholder="For example:\nSaaS for startups...", height=120, label_visibility="collapsed", disabled=is_community_scan_running)
         community_form_submitted = st.form_submit_button("Find Communities", type="primary", use_container_width=True, disabled=is_community_scan_running)
@@ -206,120 +1947,97 @@ def show_main_app(reddit):
             if not queries_tuple:
                 st.warning("Please enter at least one search query.")
             else:
-                st.session_state.community_scan_running = True
-                st.session_state.community_cancel_scan = False
-                st.session_state.community_scan_was_cancelled = False
-                st.session_state.search_params = {"queries": queries_tuple, "direct": direct_limit, "post": post_limit, "comment": comment_limit}
+                params = {"queries": list(queries_tuple), "direct": direct_limit, "post": post_limit, "comment": comment_limit, "comment_budget": community_comment_budget or None, "force_refresh": community_force_refresh, "record": community_record}
+                st.session_state.community_job_id = runner.start('communities', st.session_state.username, params, _job_source(reddit_lease, st.session_state.username, community_force_refresh, community_record))
                 st.rerun()
 
     if is_community_scan_running:
         st.info("Community search in progress...")
-        if st.button("Cancel Search", use_container_width=True):
-            st.session_state.community_cancel_scan = True
-            st.session_state.community_scan_was_cancelled = True
-        st.session_state['progress_bar_placeholder'] = st.progress(0.0)
-        try:
-            p = st.session_state.search_params
-            st.session_state['audience_df'] = find_communities_hybrid(reddit, p['queries'], p['direct'], p['post'], p['comment'])
-        finally:
-            st.session_state.community_scan_running = False
-            st.session_state.community_cancel_scan = False
-            if 'search_params' in st.session_state: del st.session_state.search_params
-            if 'progress_bar_placeholder' in st.session_state: del st.session_state['progress_bar_placeholder']
-            st.rerun()
-
-    if st.session_state.get("community_scan_was_cancelled"):
-        st.warning("️️Community search was cancelled by the user.")
-        st.session_state.community_scan_was_cancelled = False
-        if 'audience_df' in st.session_state: del st.session_state['audience_df']
-    elif "audience_df" in st.session_state:
+        show_live_job(runner, community_job['id'], "Cancel Search")
+    elif community_job:
+        show_job_status(runner, community_job, "community search", reddit_lease)
         st.header("Search Results")
-        results_df = st.session_state['audience_df']
-        if results_df is not None and not results_df.empty:
+        results_df = _job_results(runner, community_job)
+        if not results_df.empty:
             st.dataframe(results_df, use_container_width=True, hide_index=True)
             csv_data = results_df.to_csv(index=False).encode('utf-8')
             st.download_button("📥 Download Communities as CSV", csv_data, 'community_discovery_results.csv', 'text/csv', use_container_width=True)
-        else:
+            query_hits_df = community_query_hits(runner.store.rows(community_job['id']))
+            if not query_hits_df.empty:
+                with st.expander("🔍 Hits per query"):
+                    st.dataframe(query_hits_df, use_container_width=True, hide_index=True)
+                    st.download_button("📥 Download Hits per Query as CSV", query_hits_df.to_csv(index=False).encode('utf-8'), 'community_query_hits.csv', 'text/csv', use_container_width=True)
+        elif community_job['status'] == 'done':
             st.success("✅ Search complete. No communities found for these terms.")
 
     st.divider()
 
     # --- Deel 2: Scan for Opportunities (UI Aangepast) ---
     st.header("2. Scan for Opportunities")
-    is_signal_scan_running = st.session_state.signal_scan_running
     st.markdown("Deep-dive into specific communities to find posts and comments indicating a need or problem.")
     with st.form(key="signal_scanner_form", border=True):
-        preset = st.radio("Scan Intensity", ["🟢 Fast", "🔵 Standard", "🔴 Deep", "⚙️ Custom"], index=1, horizontal=True, disabled=is_signal_scan_running)
-        c1, c2 = st.columns(2)
+        data_source = st.radio("Data source", ["🌐 Reddit (live scan)", "💾 Local corpus (instant)"], horizontal=True, help="The local corpus contains every post and comment fetched by earlier scans. Querying it is instant and uses no Reddit API quota; leave subreddits empty to search all of it.", disabled=is_signal_scan_running)
+        preset = st.radio("Scan Intensity", [*SCAN_PRESETS, "⚙️ Custom"], index=1, horizontal=True, disabled=is_signal_scan_running)
+        c1, c2, c3 = st.columns(3)
         post_limit_custom = c1.number_input("Posts per subreddit", 1, 200, 50, 1, disabled=is_signal_scan_running)
         comment_limit_custom = c2.number_input("Max comments per post", 0, 1000, 100, 10, disabled=is_signal_scan_running)
+        comment_budget = c3.number_input("Total comment budget", 0, 1000000, 0, 500, help="Maximum number of comments checked in the whole scan, spent first on the posts with the highest score and most comments. 0 means no limit.", disabled=is_signal_scan_running)
         time_filter = st.radio("Time frame for top posts", ["day", "week", "month", "year", "all"], index=2, horizontal=True, disabled=is_signal_scan_running)
+        c4, c5 = st.columns(2)
+        parallel_scan = c4.toggle("⚡ Parallel scan", value=True, help="Scan subreddits and comment trees concurrently. All workers share one Reddit rate-limit budget.", disabled=is_signal_scan_running)
+        parallel_workers = c5.slider("Parallel workers", 2, 16, 8, disabled=is_signal_scan_running)
+        c6, c7 = st.columns(2)
+        signal_force_refresh = c6.toggle("♻️ Force refresh", value=False, key="signal_force_refresh_toggle", help="Ignore cached posts and comment trees and fetch everything again from Reddit.", disabled=is_signal_scan_running)
+        incremental_scan = c7.toggle("🕒 Only new since last scan", value=False, help="Skip posts that did not change since your last scan with these keywords, and only report new opportunities.", disabled=is_signal_scan_running)
+        signal_record = st.toggle("🎞️ Record for offline replay", value=False, key="signal_record_toggle", help="Save everything this scan fetches as a replay dataset for benchmark.py --dataset.", disabled=is_signal_scan_running)
         subreddits_input = st.text_area("Subreddits to scan (one per line)", placeholder="e.g. sidehustle\nsolopreneur", height=120, disabled=is_signal_scan_running)
         keywords_input = st.text_area("Pain point keywords (one per line)", placeholder="e.g. market research\nfind clients", height=120, disabled=is_signal_scan_running)
         signal_form_submitted = st.form_submit_button("🔎 Run Opportunity finder", type="primary", use_container_width=True, disabled=is_signal_scan_running)
     
     if signal_form_submitted and not is_signal_scan_running:
-        if 'signals_df' in st.session_state:
-            del st.session_state['signals_df']
-
-        subreddits_list = [s.strip() for s in subreddits_input.split('\n') if s.strip()]
+        subreddits_list = [s.replace('r/', '').strip() for s in subreddits_input.split('\n') if s.strip()]
         keywords_list = [k.strip() for k in keywords_input.split('\n') if k.strip()]
+        st.session_state.pop('corpus_results', None)
         
-        if not subreddits_list or not keywords_list:
+        if data_source.startswith("💾"):
+            if not keywords_list:
+                st.error("❗ Please provide keywords to query the local corpus.")
+            else:
+                st.session_state.pop('signal_job_id', None)
+                st.session_state['corpus_results'] = SignalResults.from_rows(get_corpus_index().query(st.session_state.username, KeywordMatcher(keywords_list), subreddits_list))
+        elif not subreddits_list or not keywords_list:
             st.error("❗ Please provide both subreddits and keywords to start a scan.")
         else:
-            st.session_state.signal_scan_running = True
-            st.session_state.signal_cancel_scan = False
-            st.session_state.signal_scan_was_cancelled = False
-            if preset.startswith("🟢"): st.session_state.limits = (10, 20)
-            elif preset.startswith("🔵"): st.session_state.limits = (50, 100)
-            elif preset.startswith("🔴"): st.session_state.limits = (100, 500)
-            else: st.session_state.limits = (post_limit_custom, comment_limit_custom)
-            st.session_state.time_filter = time_filter
-            st.session_state.subreddits = subreddits_list
-            st.session_state.keywords = keywords_list
+            limits = SCAN_PRESETS.get(preset, (post_limit_custom, comment_limit_custom))
+            params = {"subreddits": subreddits_list, "keywords": keywords_list, "time_filter": time_filter, "post_limit": limits[0], "comment_limit": limits[1], "workers": parallel_workers if parallel_scan else 1, "incremental": incremental_scan, "comment_budget": comment_budget or None, "force_refresh": signal_force_refresh, "record": signal_record}
+            st.session_state.signal_job_id = runner.start('signals', st.session_state.username, params, _job_source(reddit_lease, st.session_state.username, signal_force_refresh, signal_record))
             st.rerun()
 
-    if is_signal_scan_running:
-        st.info("🔎 Opportunity scan in progress...")
-        if st.button("Cancel Opportunity Scan", use_container_width=True):
-            st.session_state.signal_cancel_scan = True
-            st.session_state.signal_scan_was_cancelled = True
-        
-        all_signals, progress_bar = [], st.progress(0.0, text="Starting scan...")
-        try:
-            post_limit, comment_limit = st.session_state.limits
-            custom_subreddits, custom_keywords = st.session_state.subreddits, st.session_state.keywords
-            
-            for i, sub_name_raw in enumerate(custom_subreddits):
-                if st.session_state.signal_cancel_scan: break
-                sub_name = sub_name_raw.replace('r/', '').strip()
-                progress_bar.progress(i / len(custom_subreddits), text=f"Scanning r/{sub_name}...")
-                try:
-                    signals = find_buying_signals(reddit, sub_name, custom_keywords, st.session_state.time_filter, post_limit, comment_limit)
-                    if signals: all_signals.extend(signals)
-                except (NotFound, Forbidden, BadRequest) as e: st.warning(f"Skipped r/{sub_name}: {e.__class__.__name__}")
-            
-            st.session_state["signals_df"] = pd.DataFrame(all_signals) if all_signals else pd.DataFrame()
-        finally:
-            st.session_state.signal_scan_running = False
-            st.session_state.signal_cancel_scan = False
-            st.rerun()
-
-    if st.session_state.get("signal_scan_was_cancelled"):
-        st.warning("️️Opportunity scan was cancelled by the user.")
-        st.session_state.signal_scan_was_cancelled = False
-        if "signals_df" in st.session_state: del st.session_state["signals_df"]
-    elif "signals_df" in st.session_state:
-        df_signals = st.session_state["signals_df"]
-        if not df_signals.empty:
-            st.success(f"✅ Success! Found {len(df_signals)} opportunities.")
-            st.dataframe(df_signals, use_container_width=True, hide_index=True)
-            csv_signals = df_signals.to_csv(index=False).encode('utf-8')
-            st.download_button("📥 Download Opportunities as CSV", csv_signals, 'opportunity_finder_opportunities.csv', 'text/csv', use_container_width=True)
+    if 'corpus_results' in st.session_state:
+        corpus_results = st.session_state['corpus_results']
+        st.caption(f"Local corpus: {get_corpus_index().count(st.session_state.username)} indexed posts and comments.")
+        if len(corpus_results):
+            st.success(f"✅ Found {len(corpus_results)} opportunities in the local corpus.")
+            show_signal_results(corpus_results, 'corpus', 'opportunity_finder_corpus')
         else:
+            st.info("No opportunities in the local corpus for these terms. Run a live scan to fetch fresh data.")
+    elif is_signal_scan_running:
+        st.info("🔎 Opportunity scan in progress...")
+        show_live_job(runner, signal_job['id'], "Cancel Opportunity Scan")
+    elif signal_job:
+        show_job_status(runner, signal_job, "opportunity scan", reddit_lease)
+        signal_results, results_key = _job_results(runner, signal_job), signal_job['id']
+        params = signal_job['params']
+        if params.get('incremental'):
+            st.caption(f"Incremental scan: {len(signal_results)} new opportunities since the last scan.")
+            if st.toggle("📚 Merge with history", value=False, help="Show all opportunities ever found for these subreddits and keywords, not just the new ones."):
+                signal_results, results_key = SignalResults.from_rows(runner.history.signals(signal_job['owner'], params['subreddits'], KeywordMatcher(params['keywords']))), f"{signal_job['id']}_history"
+        if len(signal_results):
+            st.success(f"✅ Success! Found {len(signal_results)} opportunities.")
+            show_signal_results(signal_results, results_key, 'opportunity_finder_opportunities')
+        elif signal_job['status'] == 'done' and st.session_state.get('toasted_job_id') != signal_job['id']:
             st.toast("✅ Scan complete. No opportunities were found for these terms.")
-            del st.session_state['signals_df'] # Verwijder state zodat toast niet opnieuw verschijnt
+            st.session_state['toasted_job_id'] = signal_job['id'] # Onthoud de job zodat de toast niet bij elke rerun opnieuw verschijnt
 
 # --- Hoofdlogica (Login State Machine) ---
 def main():
@@ -327,10 +2045,10 @@ def main():
     auth_code = st.query_params.get("code")
     if "refresh_token" in st.session_state:
         try:
-            reddit_instance = praw.Reddit(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, user_agent=f"TheOpportunityFinder/Boyd (user: {st.session_state.get('username', '...')})", refresh_token=st.session_state["refresh_token"])
-            show_main_app(reddit_instance)
+            # Clients komen uit de gedeelde pool: warm over reruns en scans heen, één rate-limit budget per gebruiker.
+            show_main_app(partial(get_reddit_client_pool().lease, st.session_state["refresh_token"], st.session_state.get('username', '...')))
         except PRAWException:
-            st.error("Reddit connection failed. Please log in again."); st.session_state.clear(); st.rerun()
+            st.error("Reddit connection failed. Please log in again."); get_reddit_client_pool().discard(st.session_state["refresh_token"]); st.session_state.clear(); st.rerun()
     elif auth_code:
         try:
             temp_reddit = praw.Reddit(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI, user_agent="TheOpportunityFinder/Boyd (Token Exchange)")
@@ -0,0 +1,115 @@
+# benchmark.py - Offline benchmarks voor de scan hot paths
+#
+# Draait find_buying_signals (via iter_scan_signals) en find_communities_hybrid tegen een
+# ReplaySource met gesimuleerde latency, zodat performance-regressies reproduceerbaar zijn.
+# De 'match'-scenario's vergelijken KeywordMatcher met de oude per-keyword loop.
+#
+#   python benchmark.py                          # synthetische dataset
+#   python benchmark.py --dataset scan.json.gz   # opgenomen dataset ("Record for offline replay" in de app)
+#   python benchmark.py --latency 0.05 --json results.json
+
+import argparse
+import json
+import time
+import tracemalloc
+
+from app import (SCAN_PRESETS, KeywordMatcher, ReplaySource, generate_synthetic_dataset,
+                 iter_scan_signals, find_communities_hybrid, normalize_text)
+
+BASE_KEYWORDS = ["alternative to", "looking for", "recommend a tool", "is there an app", "willing to pay", "frustrated with", "how do you", "best way to"]
+
+def make_keywords(count: int) -> list:
+    """Vult de basislijst aan tot `count` unieke keywords (voor grote keyword-lijsten)."""
+    keywords = BASE_KEYWORDS[:count]
+    keywords += [f"keyword {i}" for i in range(count - len(keywords))]
+    return keywords
+
+def run_signals(source, matcher, subreddits, post_limit, comment_limit, workers):
+    rows = 0
+    for event in iter_scan_signals(source, subreddits, matcher, 'month', post_limit, comment_limit, workers):
+        if event[0] == 'rows': rows += len(event[3])
+    return rows
+
+def dataset_texts(dataset: dict) -> list:
+    """Alle genormaliseerde post- en comment-teksten van een dataset."""
+    texts = [normalize_text(f"{p['title']} {p['selftext']}") for sub in dataset['subreddits'].values() for p in sub['posts']]
+    texts += [normalize_text(c['body']) for comments in dataset['comments'].values() for c in comments]
+    return texts
+
+def legacy_match(keywords: list):
+    """De oorspronkelijke matcher: één substring-test per keyword."""
+    return lambda text: [k for k in keywords if k.lower() in text.lower()]
+
+def run_matching(match, texts: list) -> int:
+    return sum(1 for text in texts if match(text))
+
+def run_discovery(source, queries, direct_limit, post_limit, comment_limit):
+    return len(find_communities_hybrid(source, tuple(queries), direct_limit, post_limit, comment_limit))
+
+def measure(name: str, dataset: dict, latency: float, run) -> dict:
+    """Meet één scenario: eerst wall time/API-calls, daarna apart het geheugengebruik (tracemalloc vertraagt)."""
+    source = ReplaySource(dataset, latency)
+    start = time.perf_counter()
+    results = run(source)
+    wall = time.perf_counter() - start
+
+    tracemalloc.start()
+    run(ReplaySource(dataset, 0.0))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'scenario': name, 'wall_s': round(wall, 3), 'api_calls': source.api_calls, 'items': source.items,
+        'items_per_s': round(source.items / wall) if wall else None, 'peak_mb': round(peak / 2**20, 1), 'results': results,
+        'phases': source.metrics.snapshot()['phases'],
+    }
+
+def scenarios(args, dataset: dict):
+    subreddits = list(dataset['subreddits'])
+    matcher = KeywordMatcher(BASE_KEYWORDS)
+    for preset, (post_limit, comment_limit) in SCAN_PRESETS.items():
+        label = preset.split(' ', 1)[1]
+        for workers in (1, args.workers):
+            yield f"signals {label} w={workers}", lambda s, p=post_limit, c=comment_limit, w=workers: run_signals(s, matcher, subreddits, p, c, w)
+    post_limit, comment_limit = SCAN_PRESETS["🔵 Standard"]
+    for count in args.keyword_counts:
+        big_matcher = KeywordMatcher(make_keywords(count))
+        yield f"signals Standard kw={count}", lambda s, m=big_matcher: run_signals(s, m, subreddits, post_limit, comment_limit, 1)
+    texts = dataset_texts(dataset)
+    for count in args.keyword_counts:
+        keywords = make_keywords(count)
+        yield f"match kw={count}", lambda s, m=KeywordMatcher(keywords): run_matching(m.match, texts)
+        yield f"match legacy kw={count}", lambda s, m=legacy_match(keywords): run_matching(m, texts)
+    yield "discovery", lambda s: run_discovery(s, BASE_KEYWORDS[:4], 25, 50, 100)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the Opportunity Finder scan paths.")
+    parser.add_argument('--dataset', help="Replay dataset (.json or .json.gz); default is a synthetic dataset")
+    parser.add_argument('--subreddits', type=int, default=5)
+    parser.add_argument('--posts', type=int, default=100, help="Posts per synthetic subreddit")
+    parser.add_argument('--comments', type=int, default=500, help="Comments per synthetic post")
+    parser.add_argument('--hit-rate', type=float, default=0.02)
+    parser.add_argument('--latency', type=float, default=0.0, help="Simulated seconds per API call")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--keyword-counts', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.dataset:
+        dataset = ReplaySource.load(args.dataset).dataset
+    else:
+        dataset = generate_synthetic_dataset(args.subreddits, args.posts, args.comments, BASE_KEYWORDS, args.hit_rate)
+
+    columns = ['scenario', 'wall_s', 'api_calls', 'items', 'items_per_s', 'peak_mb', 'results']
+    print(' | '.join(f"{c:>24}" if i == 0 else f"{c:>11}" for i, c in enumerate(columns)))
+    results = []
+    for name, run in scenarios(args, dataset):
+        result = measure(name, dataset, args.latency, run)
+        results.append(result)
+        print(' | '.join(f"{str(result[c]):>24}" if i == 0 else f"{str(result[c]):>11}" for i, c in enumerate(columns)))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()